@@ -2,22 +2,30 @@ import asyncio
 import logging
 import json
 from datetime import datetime, timezone, date, timedelta
-from typing import Optional, Dict, List, Set, Tuple
+from typing import Any, Awaitable, Callable, Optional, Dict, List, Set, Tuple
 from pathlib import Path
-from collections import defaultdict
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
 from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.enums import ChatType
 from aiogram.types import Message, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from aiogram.methods import SendMessage
+from aiogram.webhook.aiohttp_server import setup_application
 from aiohttp import web
 import aiosqlite
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 import aiohttp_cors
 
-from database import Database
+from database import Database, StorageProfile, TransactionAborted, FREEZE_OK, FREEZE_INSUFFICIENT_BALANCE, FREEZE_LIMIT_EXCEEDED
+from daily_state import ChatDayState, DailyPairState
+from notifications import StreakNotifier
+from ordering import ChatOrderMiddleware
+from outbox import OutboundDispatcher, PRIORITY_NORMAL, PRIORITY_LOW
 from config import BOT_TOKEN, WEBAPP_URL, BOT_OWNER_ID
+import config
+from webhook import BoundedRequestHandler
+from workers import WorkerSupervisor, consume_updates
 
 # Настройка логирования с более подробным форматом
 logging.basicConfig(
@@ -26,10 +34,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Способ получения апдейтов: "polling" (по умолчанию) или "webhook".
+# Необязательные настройки в config.py; без них бот работает как раньше.
+UPDATE_MODE = getattr(config, "UPDATE_MODE", "polling")
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)  # публичный https-адрес, который проксируется на WEBHOOK_PATH
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+# Предел одновременно обрабатываемых апдейтов (при WORKER_PROCESSES > 1 - в каждом воркере и в приеме вебхука)
+WEBHOOK_MAX_CONCURRENT_UPDATES = getattr(config, "WEBHOOK_MAX_CONCURRENT_UPDATES", 100)
+# Больше 1 - апдейты обрабатывают отдельные процессы, группы делятся по chat_id (см. workers.py)
+WORKER_PROCESSES = getattr(config, "WORKER_PROCESSES", 1)
+# Предел памяти на состояние чатов за день; давно молчавшие чаты вытесняются и подгружаются из БД
+DAILY_STATE_MAX_BYTES = getattr(config, "DAILY_STATE_MAX_BYTES", 64 * 1024 * 1024)
+
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
 # dp = Dispatcher() # Уберем инициализацию dp здесь, сделаем в main
-db = Database()
+# Несколько процессов пишут в одну БД - add_user перепроверяет имена, известные по памяти
+db = Database(profile=StorageProfile(verify_known_users=WORKER_PROCESSES > 1))
+
+# Все исходящие сообщения идут через очередь с лимитами Telegram (см. outbox.py)
+TELEGRAM_GLOBAL_RATE = 30.0 # сообщений в секунду на бота
+outbox = OutboundDispatcher(bot, global_rate=TELEGRAM_GLOBAL_RATE)
+
+
+async def queue_streak_digest(chat_id: int, text: str):
+    outbox.submit(SendMessage(chat_id=chat_id, text=text), PRIORITY_LOW)
+
+
+# Уведомления о стриках копятся по чатам и уходят одним сообщением-дайджестом
+NOTIFICATION_DEBOUNCE_SECONDS = getattr(config, "NOTIFICATION_DEBOUNCE_SECONDS", 3.0)
+streak_notifier = StreakNotifier(queue_streak_digest, debounce_s=NOTIFICATION_DEBOUNCE_SECONDS)
+
+# Апдейты одного чата обрабатываются по очереди, разных чатов - параллельно
+update_order = ChatOrderMiddleware()
 
 # Путь к веб-приложению
 WEBAPP_PATH = Path(__file__).parent / "docs"
@@ -37,30 +75,77 @@ WEBAPP_PATH = Path(__file__).parent / "docs"
 # Создаем веб-сервер
 routes = web.RouteTableDef()
 
-# Кеш для отслеживания активности в группах
-# {chat_id: {user_id}} - кто писал сегодня
-group_activity_today: Dict[int, Set[int]] = defaultdict(set)
-# {chat_id: {(user1_id, user2_id)}} - каким парам уже отправили уведомление о стрике сегодня
-notified_streaks_today: Dict[int, Set[Tuple[int, int]]] = defaultdict(set)
+# Состояние групп за сегодня: кто писал, какие пары подтверждены
+# и каким парам уже отправили уведомление (см. daily_state.ChatDayState)
+daily_state = DailyPairState(
+    loader=lambda day, chat_id: db.load_daily_state(day, chat_id),
+    max_bytes=DAILY_STATE_MAX_BYTES,
+)
 
 # Переменная для хранения текущей даты, чтобы сбрасывать кеш раз в сутки
 current_bot_date: Optional[date] = None
 
-async def reset_daily_caches_if_new_day():
-    """Сбрасывает кеши, если наступил новый день."""
-    global current_bot_date, group_activity_today, notified_streaks_today
+# Последнее ежедневное обслуживание БД: дата, длительность в секундах и число затронутых строк
+# (выводится вместе с метриками outbox в stop_services)
+rollover_stats: Dict[str, object] = {"date": None, "duration_s": None}
+rollover_task: Optional[asyncio.Task] = None
+# В режиме нескольких процессов обслуживание БД при смене дня делает только один из них
+daily_maintenance_enabled = True
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+background_tasks: Set[asyncio.Task] = set()
+
+def reset_daily_caches_if_new_day():
+    """Дешевая проверка для обработчиков: если наступил новый день, а планировщик
+    еще не успел (или часы сдвинулись), сразу переключает кеши, а работу с БД
+    запускает в фоне. Синхронная, поэтому гонок за current_bot_date нет."""
     today = datetime.now(timezone.utc).date()
     if current_bot_date != today:
-        logger.info(f"Новый день ({today})! Сбрасываем ежедневные кеши.")
-        group_activity_today.clear()
-        notified_streaks_today.clear()
-        current_bot_date = today
-        # Добавляем сброс неактивных стриков
-        try:
-            logger.info(f"DB: Вызов reset_inactive_streaks для даты {today}")
-            await db.reset_inactive_streaks(today)
-        except Exception as e:
-            logger.error(f"DB: Ошибка при вызове db.reset_inactive_streaks: {e}", exc_info=True)
+        roll_over_day(today)
+
+
+def roll_over_day(today: date):
+    """Переключает ежедневные кеши на новый день и запускает обслуживание БД в фоне."""
+    global current_bot_date
+    logger.info(f"Новый день ({today})! Сбрасываем ежедневные кеши.")
+    logger.info(f"Кэш имен пользователей: {db.identity_cache.stats()}")
+    logger.info(f"Состояние чатов за день: {daily_state.stats()}, самые большие: {daily_state.memory_report(5)}")
+    daily_state.reset(today)
+    current_bot_date = today
+    if not daily_maintenance_enabled:
+        return
+    maintenance_task = asyncio.create_task(run_daily_maintenance(today))
+    background_tasks.add(maintenance_task)
+    maintenance_task.add_done_callback(background_tasks.discard)
+
+
+async def run_daily_maintenance(today: date):
+    """Сброс неактивных стриков, удаление истекших заморозок и сворачивание старых сообщений."""
+    started = asyncio.get_running_loop().time()
+    rows: Dict[str, int] = {}
+    try:
+        logger.info(f"DB: Вызов reset_inactive_streaks для даты {today}")
+        rows["streaks_reset"] = await db.reset_inactive_streaks(today)
+        rows["freezes_expired"] = await db.sweep_expired_freezes(today)
+        rows["daily_state_pruned"] = await db.prune_daily_state(today)
+    except Exception as e:
+        logger.error(f"DB: Ошибка при вызове db.reset_inactive_streaks: {e}", exc_info=True)
+    # Сворачивание старых сообщений в сводку активности, а старых дней сводки - в одну строку на пару
+    rows["messages_compacted"] = await db.compact_messages(today)
+    rows["activity_folded"] = await db.fold_daily_activity(today)
+    duration = asyncio.get_running_loop().time() - started
+    rollover_stats.clear()
+    rollover_stats.update(date=today.isoformat(), duration_s=round(duration, 3), **rows)
+    logger.info(f"Ежедневное обслуживание за {today} заняло {duration:.3f} с: {rows}")
+
+
+async def daily_rollover_scheduler():
+    """Фоновая задача: просыпается в полночь UTC и переключает день, не дожидаясь первого апдейта."""
+    while True:
+        now = datetime.now(timezone.utc)
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+        await asyncio.sleep((next_midnight - now).total_seconds())
+        reset_daily_caches_if_new_day()
 
 @routes.get('/')
 async def serve_webapp(request):
@@ -160,54 +245,57 @@ async def post_webapp_freeze_streak(request):
 
         FREEZE_COST_PER_DAY = 1 
         cost = days_to_freeze * FREEZE_COST_PER_DAY
-        user_balance = await db.get_user_balance(user_id)
+        today = datetime.now(timezone.utc).date()
+        target_username = await db.get_username_by_id(partner_id) or str(partner_id)
+
+        # Списание баллов, заморозка и запись в журнал - одна транзакция
+        purchase = await db.purchase_streak_freeze(user_id, partner_id, days_to_freeze, cost, today)
 
-        if user_balance < cost:
-            logger.info(f"/api/webapp/freeze_streak: Insufficient balance for user {user_id}. Needed: {cost}, Has: {user_balance}")
+        if purchase.status == FREEZE_INSUFFICIENT_BALANCE:
+            logger.info(f"/api/webapp/freeze_streak: Insufficient balance for user {user_id}. Needed: {cost}, Has: {purchase.balance}")
             return web.json_response({
                 'success': False, 
-                'message': f'Недостаточно баллов. Нужно: {cost}, у вас: {user_balance}',
+                'message': f'Недостаточно баллов. Нужно: {cost}, у вас: {purchase.balance}',
                 'error': 'insufficient_balance',
                 'new_freeze_end_date': None
             }, status=200) 
 
-        today = datetime.now(timezone.utc).date()
-        current_freeze_end_date = await db.get_active_freeze(user_id, partner_id, today)
-        
-        if current_freeze_end_date:
-            start_date_for_new_freeze = current_freeze_end_date
-        else:
-            start_date_for_new_freeze = today
-        
-        final_freeze_end_date = start_date_for_new_freeze + timedelta(days=days_to_freeze)
+        if purchase.status == FREEZE_LIMIT_EXCEEDED:
+            return web.json_response({
+                'success': False,
+                'message': f'Общая длительность заморозки с @{target_username} не может превышать 60 дней от текущей даты.',
+                'error': 'freeze_limit_exceeded',
+                'new_freeze_end_date': None
+            }, status=200)
 
-        # Ограничение на общую длительность заморозки, например, 60 дней от сегодня
-        if (final_freeze_end_date - today).days > 60: 
-            await message.answer(f"⚠️ Общая длительность заморозки с @{target_username} не может превышать 60 дней от текущей даты. Текущий запрос на {days_to_freeze} дн. не выполнен.")
-            return
+        if purchase.status != FREEZE_OK:
+            return web.json_response({
+                'success': False,
+                'message': 'Не удалось активировать заморозку. Баллы не списаны. Попробуйте позже.',
+                'error': 'freeze_failed',
+                'new_freeze_end_date': None
+            }, status=200)
 
-        if await db.update_user_balance(user_id, -cost): 
-            if await db.add_streak_freeze(user_id, partner_id, final_freeze_end_date):
-                # Формируем основное сообщение для пользователя
-                if current_freeze_end_date:
-                    response_message_start = f"❄️ Заморозка с @{target_username} продлена до {final_freeze_end_date.strftime('%d.%m.%Y')}!"
-                else:
-                    response_message_start = f"❄️ Стрик с @{target_username} успешно заморожен до {final_freeze_end_date.strftime('%d.%m.%Y')}!"
-                
-                await message.answer(f"{response_message_start}\nСписано {cost} балл(ов). Ваш новый баланс: {user_balance - cost}.")
-                
-                # Формируем уведомление для партнера
-                try:
-                    partner_notification_action = 'продлил' if current_freeze_end_date else 'установил'
-                    partner_notification_message = f"ℹ️ Пользователь @{message.from_user.username} {partner_notification_action} заморозку вашего общего стрика до {final_freeze_end_date.strftime('%d.%m.%Y')}."
-                    await bot.send_message(partner_id, partner_notification_message)
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить уведомление о заморозке партнеру {partner_id}: {e}")
-            else:
-                await db.update_user_balance(user_id, cost) 
-                await message.answer("❌ Не удалось активировать заморозку. Баллы не списаны. Попробуйте позже.")
+        if purchase.previous_end_date:
+            response_message = f"❄️ Заморозка с @{target_username} продлена до {purchase.new_end_date.strftime('%d.%m.%Y')}!"
         else:
-            await message.answer("❌ Ошибка при списании баллов. Заморозка не активирована.")
+            response_message = f"❄️ Стрик с @{target_username} успешно заморожен до {purchase.new_end_date.strftime('%d.%m.%Y')}!"
+
+        # Уведомление для партнера
+        try:
+            initiator_username = await db.get_username_by_id(user_id) or str(user_id)
+            partner_notification_action = 'продлил' if purchase.previous_end_date else 'установил'
+            partner_notification_message = f"ℹ️ Пользователь @{initiator_username} {partner_notification_action} заморозку вашего общего стрика до {purchase.new_end_date.strftime('%d.%m.%Y')}."
+            outbox.submit(SendMessage(chat_id=partner_id, text=partner_notification_message), PRIORITY_NORMAL)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление о заморозке партнеру {partner_id}: {e}")
+
+        return web.json_response({
+            'success': True,
+            'message': f"{response_message}\nСписано {cost} балл(ов). Ваш новый баланс: {purchase.balance}.",
+            'new_balance': purchase.balance,
+            'new_freeze_end_date': purchase.new_end_date.isoformat()
+        })
 
     except json.JSONDecodeError:
         logger.error("/api/webapp/freeze_streak: Invalid JSON payload.")
@@ -258,7 +346,7 @@ async def setup_bot_commands():
 
 # УБИРАЕМ ДЕКОРАТОРЫ, ТАК КАК РЕГИСТРАЦИЯ В MAIN
 async def cmd_start(message: Message, command: Optional[CommandObject] = None): # Добавил CommandObject для консистентности, хотя CommandStart не передает его
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     await db.add_user(
         user_id=message.from_user.id,
         username=message.from_user.username or str(message.from_user.id)
@@ -272,7 +360,7 @@ async def cmd_start(message: Message, command: Optional[CommandObject] = None):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[webapp_button]])
     
     if message.chat.type == ChatType.PRIVATE:
-        await message.answer(
+        outbox.submit(message.answer(
             "🌟 Добро пожаловать в Streak Buddy!\n\n"
             "Я помогу вам отслеживать регулярность общения с друзьями и близкими. "
             "Каждый день общения увеличивает вашу серию (стрик), а пропуск дня сбрасывает её.\n\n"
@@ -288,9 +376,9 @@ async def cmd_start(message: Message, command: Optional[CommandObject] = None):
             "Нажмите на кнопку ниже, чтобы открыть удобный интерфейс:",
             reply_markup=keyboard,
             parse_mode="HTML"
-        )
+        ))
     else:
-        await message.answer(
+        outbox.submit(message.answer(
             "✨ <b>Streak Buddy активирован в этой группе!</b>\n\n"
             "🤝 <b>Как это работает:</b>\n"
             "• Бот автоматически отслеживает общение участников\n"
@@ -299,12 +387,12 @@ async def cmd_start(message: Message, command: Optional[CommandObject] = None):
             "• Пропуск дня сбрасывает стрик\n\n"
             "💫 Общайтесь регулярно и побейте рекорд группы!",
             parse_mode="HTML"
-        )
+        ))
 
 async def cmd_webapp(message: Message, command: Optional[CommandObject] = None):
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     if message.chat.type != ChatType.PRIVATE:
-        await message.answer("⚠️ Эта команда работает только в личных сообщениях с ботом.")
+        outbox.submit(message.answer("⚠️ Эта команда работает только в личных сообщениях с ботом."))
         return
     
     webapp_button = InlineKeyboardButton(
@@ -313,55 +401,53 @@ async def cmd_webapp(message: Message, command: Optional[CommandObject] = None):
     )
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[webapp_button]])
     
-    await message.answer(
+    outbox.submit(message.answer(
         "Нажмите на кнопку ниже, чтобы открыть удобный интерфейс для отслеживания общения:",
         reply_markup=keyboard
-    )
+    ))
 
 async def cmd_chat(message: Message, command: CommandObject):
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     if message.chat.type != ChatType.PRIVATE:
-        await message.answer(
+        outbox.submit(message.answer(
             "⚠️ Эта команда работает только в личных сообщениях с ботом."
-        )
+        ))
         return
 
     if not command.args:
-        await message.answer(
+        outbox.submit(message.answer(
             "ℹ️ Пожалуйста, укажите username пользователя.\n"
             "Пример: /chat @username"
-        )
+        ))
         return
 
     user_id = message.from_user.id
     target_username = command.args.strip('@')
     
-    # Проверяем, что пользователь не пытается добавить сам себя
-    if message.from_user.username and target_username == message.from_user.username:
-        await message.answer("❌ Вы не можете добавить сами себя.")
-        return
-    
     # Получаем ID целевого пользователя
     target_id = await db.get_user_id_by_username(target_username)
     if not target_id:
-        await message.answer(
+        outbox.submit(message.answer(
             f"❌ Пользователь @{target_username} еще не использовал бота.\n"
             "Попросите его сначала запустить бота командой /start"
-        )
+        ))
+        return
+
+    # Проверяем, что пользователь не пытается добавить сам себя
+    # (по ID: поиск по username не учитывает регистр)
+    if target_id == user_id:
+        outbox.submit(message.answer("❌ Вы не можете добавить сами себя."))
         return
 
     # Проверяем, есть ли уже запрос на стрик
     existing_request = await db.get_streak_request(user_id, target_id)
     if existing_request:
-        await message.answer(
+        outbox.submit(message.answer(
             f"✋ Вы уже отправили запрос на стрик пользователю @{target_username}.\n"
             "Ожидайте подтверждения!"
-        )
+        ))
         return
 
-    # Добавляем запрос на стрик
-    await db.add_streak_request(user_id, target_id)
-    
     # Отправляем уведомление целевому пользователю
     accept_button = InlineKeyboardButton(
         text="✅ Принять",
@@ -372,54 +458,69 @@ async def cmd_chat(message: Message, command: CommandObject):
         callback_data=f"decline_streak:{user_id}"
     )
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[accept_button, decline_button]])
-    
-    await bot.send_message(
-        target_id,
-        f"👋 Пользователь @{message.from_user.username} хочет отслеживать общение с вами!\n\n"
-        "Вы можете принять или отклонить запрос:",
-        reply_markup=keyboard
-    )
-    
-    await message.answer(
+
+    # Ждем доставки (мимо отложенных до COMMIT ответов) и до первой записи, пока транзакция
+    # не держит писателя: если Telegram отказал (бот заблокирован, чат недоступен),
+    # запрос не сохраняется, а отправитель узнает об ошибке
+    try:
+        await outbox.submit(SendMessage(
+            chat_id=target_id,
+            text=f"👋 Пользователь @{message.from_user.username} хочет отслеживать общение с вами!\n\n"
+            "Вы можете принять или отклонить запрос:",
+            reply_markup=keyboard
+        ), PRIORITY_NORMAL, hold=False)
+    except Exception as e:
+        logger.warning(f"CMD: /chat - Не удалось доставить запрос от {user_id} пользователю {target_id}: {e}")
+        outbox.submit(message.answer(
+            f"❌ Не удалось отправить запрос пользователю @{target_username}.\n"
+            "Возможно, он заблокировал бота. Попробуйте позже."
+        ))
+        return
+
+    # Добавляем запрос на стрик
+    await db.add_streak_request(user_id, target_id)
+
+    outbox.submit(message.answer(
         f"✅ Запрос на отслеживание общения отправлен пользователю @{target_username}.\n"
         "Я сообщу, когда он примет или отклонит запрос!"
-    )
+    ))
 
 async def process_streak_request(callback_query: types.CallbackQuery):
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     action, user_id_str = callback_query.data.split(":")
     from_user_id = int(user_id_str)
     to_user_id = callback_query.from_user.id
     
     if action == "accept_streak":
+        # Запрос к Telegram - до первой записи, пока транзакция не держит писателя
+        from_user_chat = await bot.get_chat(from_user_id)
+
         # Добавляем пользователей друг другу
         await db.add_streak_pair(from_user_id, to_user_id)
-        
-        from_user_chat = await bot.get_chat(from_user_id)
         to_user_username = callback_query.from_user.username or str(to_user_id)
 
         # Уведомляем обоих пользователей
-        await bot.send_message(
-            from_user_id,
-            f"🎉 @{to_user_username} принял ваш запрос на отслеживание общения!\n"
+        outbox.submit(SendMessage(
+            chat_id=from_user_id,
+            text=f"🎉 @{to_user_username} принял ваш запрос на отслеживание общения!\n"
             "Теперь вы можете отмечать общение каждый день."
-        )
+        ), PRIORITY_NORMAL)
         
-        await callback_query.message.edit_text(
+        outbox.submit(callback_query.message.edit_text(
             "✅ Вы приняли запрос на отслеживание общения.\n"
             f"Теперь вы будете отслеживать общение с @{from_user_chat.username or str(from_user_id)}"
-        )
+        ))
         
     else:  # decline_streak
         to_user_username = callback_query.from_user.username or str(to_user_id)
-        await bot.send_message(
-            from_user_id,
-            f"😔 @{to_user_username} отклонил ваш запрос на отслеживание общения."
-        )
+        outbox.submit(SendMessage(
+            chat_id=from_user_id,
+            text=f"😔 @{to_user_username} отклонил ваш запрос на отслеживание общения."
+        ), PRIORITY_NORMAL)
         
-        await callback_query.message.edit_text(
+        outbox.submit(callback_query.message.edit_text(
             "❌ Вы отклонили запрос на отслеживание общения."
-        )
+        ))
     
     # Удаляем запрос
     await db.remove_streak_request(from_user_id, to_user_id)
@@ -484,7 +585,7 @@ async def send_streaks_data(user_id: int, is_webapp_request: bool = False):
 
 async def handle_webapp_data(message: Message):
     """Обработчик данных от веб-приложения"""
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     try:
         data = json.loads(message.web_app_data.data)
         action = data.get('action')
@@ -493,13 +594,13 @@ async def handle_webapp_data(message: Message):
         if action == 'mark_today':
             partner_id_to_mark = data.get('partner_id')
             if not partner_id_to_mark:
-                await message.answer("Ошибка: не указан ID партнера для отметки.")
+                outbox.submit(message.answer("Ошибка: не указан ID партнера для отметки."))
                 return
 
             today = datetime.now(timezone.utc).date()
             status_msg, streak_updated = await db.mark_webapp_interaction(user_id, int(partner_id_to_mark), today)
             
-            await message.answer(status_msg) # Сообщаем пользователю результат
+            outbox.submit(message.answer(status_msg)) # Сообщаем пользователю результат
 
             # Если стрик обновился или просто для актуальности, попросим WebApp обновить данные
             # Это можно сделать, отправив специальный ответ или просто положившись, 
@@ -552,7 +653,7 @@ async def handle_webapp_data(message: Message):
                 logger.info(f"WebApp: Sent streaks data to WebApp for user {user_id} via answer_web_app_query.")
             except Exception as e:
                 logger.error(f"WebApp: Error sending data via answer_web_app_query: {e}", exc_info=True)
-                await message.answer("Не удалось отправить данные в веб-интерфейс. Попробуйте обновить его.")
+                outbox.submit(message.answer("Не удалось отправить данные в веб-интерфейс. Попробуйте обновить его."))
 
         elif action == 'select_user':
             target_username = data.get('username')
@@ -564,11 +665,11 @@ async def handle_webapp_data(message: Message):
                 await send_streaks_data(message.from_user.id, is_webapp_request=True)
             
     except json.JSONDecodeError:
-        await message.answer("❌ Произошла ошибка при обработке данных.")
+        outbox.submit(message.answer("❌ Произошла ошибка при обработке данных."))
 
 async def handle_message(message: Message):
     """Обработчик всех остальных сообщений"""
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     
     user_id = message.from_user.id
     username = message.from_user.username or str(user_id)
@@ -614,103 +715,95 @@ async def handle_message(message: Message):
         logger.info("Сообщение не в группе/супергруппе, пропускаем обработку стриков.")
         return
 
-    # Обновляем активность пользователя в чате
-    group_activity_today[chat_id].add(user_id)
-    logger.info(f"Пользователь {username} ({user_id}) отмечен активным в чате {chat_id}. Активные: {group_activity_today[chat_id]}")
+    # Обновляем активность пользователя в чате и получаем его пары, еще не подтвержденные
+    # сегодня. Пары без его участия не меняются от его сообщения, а подтвержденная пара
+    # второй раз не обрабатывается, поэтому повторные сообщения не обращаются к БД.
+    chat_state = await daily_state.get_chat(chat_id)
+    first_today = not chat_state.is_active(user_id)
+    pending_partners = chat_state.observe(user_id)
 
-    # Получаем список всех активных пользователей в этом чате сегодня
-    active_users_in_chat = list(group_activity_today[chat_id])
-    
-    if len(active_users_in_chat) < 2:
-        logger.info("Менее двух активных пользователей в чате, стрики невозможны.")
+    if first_today:
+        # Нужен для восстановления чата из БД, пока у пользователя нет ни одной пары
+        await db.add_daily_active_user(chat_id, today, user_id)
+
+    if not pending_partners:
+        logger.info(f"Нет неподтвержденных пар для {user_id} в чате {chat_id}.")
         return
 
-    logger.info(f"Обработка пар для чата {chat_id}. Активные пользователи: {active_users_in_chat}")
+    logger.info(f"Обработка {len(pending_partners)} пар для {user_id} в чате {chat_id}: {pending_partners}")
+
+    # Все пары одного сообщения записываются в транзакции апдейта (см. TransactionMiddleware).
+    # Состояние чата обновляется и уведомления ставятся в очередь только после COMMIT;
+    # при ошибке пары остаются неподтвержденными и будут обработаны со следующим сообщением.
+    async with db.transaction() as tx:
+        results = await db.record_pair_interactions(user_id, pending_partners, today, chat_id) # Передаем chat_id как chat_id_context
+        notifications = await build_pair_notifications(chat_state, chat_id, user_id, results)
+        # Пары, о которых объявим, записываются в той же транзакции:
+        # после перезапуска повторного уведомления не будет
+        await db.add_daily_notifications(chat_id, today, [(user_id, partner_id) for partner_id in notifications])
+        tx.after_commit(lambda: apply_confirmed_pairs(chat_state, chat_id, user_id, results, notifications))
+
+
+async def build_pair_notifications(chat_state: ChatDayState, chat_id: int, user_id: int,
+                                   results: Dict[int, Tuple[int, int]]) -> Dict[int, str]:
+    """Тексты уведомлений о новом или продленном стрике подтвержденных пар (раз в день): {partner_id: текст}."""
+    notifications: Dict[int, str] = {}
+    for partner_id, (streak_before, streak_after) in results.items():
+        # Сортируем ID, чтобы ключ пары в логах был консистентным
+        pair_key = tuple(sorted((user_id, partner_id)))
+        logger.info(f"Pair {pair_key} confirmed today in chat {chat_id}. Streak: {streak_before} -> {streak_after}")
+        if chat_state.is_notified(user_id, partner_id):
+            logger.info(f"Notification for {pair_key} already sent today.")
+        elif streak_after > streak_before:
+            logger.info(f"Streak for {pair_key} increased ({streak_before} -> {streak_after}). Sending notification.")
+            notifications[partner_id] = await pair_streak_text(user_id, partner_id, streak_before, streak_after)
+        else:
+            logger.info(f"Streak for {pair_key} did not increase ({streak_before} -> {streak_after}). No notification needed.")
+    return notifications
 
-    # Перебираем все уникальные пары активных пользователей
-    for i in range(len(active_users_in_chat)):
-        for j in range(i + 1, len(active_users_in_chat)):
-            user1_id = active_users_in_chat[i]
-            user2_id = active_users_in_chat[j]
 
-            # Сортируем ID, чтобы ключ для notified_streaks_today был консистентным
-            pair_key = tuple(sorted((user1_id, user2_id)))
+async def pair_streak_text(user1_id: int, user2_id: int, streak_before: int, streak_after: int) -> str:
+    user1_username = await db.get_username_by_id(user1_id) or str(user1_id)
+    user2_username = await db.get_username_by_id(user2_id) or str(user2_id)
 
-            logger.info(f"Processing pair: {pair_key} in chat {chat_id}")
+    user1_mention = f"@{user1_username}" if not user1_username.startswith('@') else user1_username
+    user2_mention = f"@{user2_username}" if not user2_username.startswith('@') else user2_username
 
-            # Убеждаемся, что пара для стрика существует, если нет - создаем
-            await db.add_streak_pair(user1_id, user2_id) # Создаст симметричную пару, если ее нет
-            logger.info(f"Ensured streak_pair exists for {pair_key}")
-            
-            streak_before = await db.get_streak_count(user1_id, user2_id) # Стрик симметричен
-            logger.info(f"Streak BEFORE for {pair_key}: {streak_before}")
-
-            # Вызываем mark_message для КАЖДОГО из участников пары.
-            # Внутренняя логика mark_message обновит стрик только если ОБА направления активны сегодня.
-            # Если текущий отправитель (message.from_user.id) равен user1_id, то его сообщение уже записано.
-            # Если он равен user2_id, то его сообщение тоже.
-            # Нам нужно, чтобы mark_message была вызвана для обеих "перспектив" пары.
-            
-            # Если сообщение пришло от user1_id, то его mark_message вызовется с (user1_id, user2_id, today)
-            # Если сообщение пришло от user2_id, то его mark_message вызовется с (user2_id, user1_id, today)
-            # Но нам нужно обработать пару (user1_id, user2_id) целиком.
-            
-            # Логика такая: mark_message(A,B) записывает сообщение A->B 
-            # и если есть B->A, то обновляет стрик для A-B.
-            await db.mark_message(user1_id, user2_id, today, chat_id) # Передаем chat_id как chat_id_context
-            await db.mark_message(user2_id, user1_id, today, chat_id) # Передаем chat_id как chat_id_context
-            
-            # После вызова mark_message для обеих "перспектив", стрик должен быть актуален.
-            # Проверяем, действительно ли оба пользователя отметились сегодня В ЭТОМ ЧАТЕ
-            if await db.check_both_marked(user1_id, user2_id, today, chat_id): # Передаем chat_id как chat_id_context
-                logger.info(f"Pair {pair_key} confirmed as both marked today in chat {chat_id}.")
-                streak_after = await db.get_streak_count(user1_id, user2_id)
-                logger.info(f"Streak AFTER for {pair_key}: {streak_after}")
-
-                if streak_after > streak_before and pair_key not in notified_streaks_today[chat_id]:
-                    logger.info(f"Streak for {pair_key} increased ({streak_before} -> {streak_after}). Sending notification.")
-                    
-                    user1_username = await db.get_username_by_id(user1_id) or str(user1_id)
-                    user2_username = await db.get_username_by_id(user2_id) or str(user2_id)
-                    
-                    user1_mention = f"@{user1_username}" if not user1_username.startswith('@') else user1_username
-                    user2_mention = f"@{user2_username}" if not user2_username.startswith('@') else user2_username
+    days_word = get_days_word(streak_after)
 
-                    days_word = get_days_word(streak_after)
-                    
-                    message_text = f"🎯 {user1_mention} и {user2_mention} начали новую серию общения!"
-                    if streak_before > 0 : # Если стрик уже был, значит он продлен
-                        streak_emoji = "🔥" if streak_after >= 7 else "✨" if streak_after >= 3 else "⭐️"
-                        message_text = f"{streak_emoji} {user1_mention} и {user2_mention} продлили стрик!\nВаша серия: {streak_after} {days_word} подряд"
-
-                    await message.answer(message_text)
-                    notified_streaks_today[chat_id].add(pair_key)
-                    logger.info(f"Notification sent for {pair_key}. Added to notified_streaks_today.")
-
-                    if streak_after in [3, 7, 14, 30, 50, 100]:
-                        achievement_emoji = "🏆" if streak_after >= 30 else "🎉"
-                        await message.answer(
-                            f"{achievement_emoji} Поздравляем! {streak_after} {days_word} общения - это достижение!"
-                        )
-                elif pair_key in notified_streaks_today[chat_id]:
-                     logger.info(f"Notification for {pair_key} already sent today.")
-                elif streak_after <= streak_before:
-                    logger.info(f"Streak for {pair_key} did not increase ({streak_before} -> {streak_after}). No notification needed.")
-            else:
-                logger.info(f"Pair {pair_key} NOT confirmed as both marked today. No streak update or notification based on this message.")
+    message_text = f"🎯 {user1_mention} и {user2_mention} начали новую серию общения!"
+    if streak_before > 0 : # Если стрик уже был, значит он продлен
+        streak_emoji = "🔥" if streak_after >= 7 else "✨" if streak_after >= 3 else "⭐️"
+        message_text = f"{streak_emoji} {user1_mention} и {user2_mention} продлили стрик!\nВаша серия: {streak_after} {days_word} подряд"
+
+    if streak_after in [3, 7, 14, 30, 50, 100]:
+        achievement_emoji = "🏆" if streak_after >= 30 else "🎉"
+        message_text += f"\n{achievement_emoji} Поздравляем! {streak_after} {days_word} общения - это достижение!"
+    return message_text
+
+
+def apply_confirmed_pairs(chat_state: ChatDayState, chat_id: int, user_id: int,
+                          results: Dict[int, Tuple[int, int]], notifications: Dict[int, str]):
+    """После COMMIT: отмечает пары подтвержденными и ставит уведомления в дайджест чата."""
+    for partner_id in results:
+        chat_state.confirm(user_id, partner_id)
+    for partner_id, message_text in notifications.items():
+        streak_notifier.add(chat_id, message_text)
+        chat_state.set_notified(user_id, partner_id)
+        logger.info(f"Notification queued for {tuple(sorted((user_id, partner_id)))}. Marked as notified.")
 
 
 async def cmd_reset(message: Message, command: CommandObject):
     """Сброс стрика с конкретным пользователем"""
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     if not command.args:
-        await message.answer(
+        outbox.submit(message.answer(
             "ℹ️ <b>Как сбросить стрик:</b>\n"
             "1. Используйте команду /reset @username\n"
             "2. Стрик и история общения будут удалены\n"
             "3. Начните общение заново, чтобы создать новый стрик",
             parse_mode="HTML"
-        )
+        ))
         return
 
     user_id = message.from_user.id
@@ -719,53 +812,54 @@ async def cmd_reset(message: Message, command: CommandObject):
     # Получаем ID целевого пользователя
     target_id = await db.get_user_id_by_username(target_username)
     if not target_id:
-        await message.answer(
+        outbox.submit(message.answer(
             f"❌ Пользователь @{target_username} не найден в базе данных."
-        )
+        ))
         return
 
     # Проверяем текущий стрик перед сбросом
     current_streak = await db.get_streak_count(user_id, target_id)
     if current_streak == 0:
-        await message.answer(
+        outbox.submit(message.answer(
             f"ℹ️ У вас нет активного стрика с @{target_username}."
-        )
+        ))
         return
     
-    # Сбрасываем стрик
-    if await db.reset_streak(user_id, target_id):
+    # Сбрасываем стрик; пара снова станет неподтвержденной в состоянии дня только после COMMIT
+    async with db.transaction() as tx:
+        reset_ok = await db.reset_streak(user_id, target_id)
+        if reset_ok:
+            tx.after_commit(lambda: daily_state.forget_pair(user_id, target_id))
+    if reset_ok:
         days_word = get_days_word(current_streak)
         
         # Уведомляем инициатора сброса
-        await message.answer(
+        outbox.submit(message.answer(
             f"🔄 <b>Стрик сброшен</b>\n\n"
             f"• Собеседник: @{target_username}\n"
             f"• Серия общения была: {current_streak} {days_word}\n"
             f"• История общения удалена\n\n"
             "Начните общаться снова, чтобы создать новый стрик!",
             parse_mode="HTML"
-        )
+        ))
         
-        # Уведомляем второго пользователя
-        try:
-            await bot.send_message(
-                target_id,
-                f"❗️ <b>@{message.from_user.username} сбросил стрик общения с вами</b>\n\n"
-                f"• Ваша серия была: {current_streak} {days_word}\n"
-                f"• История общения удалена\n\n"
-                "Начните общаться снова, чтобы создать новый стрик!",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления о сбросе стрика: {e}", exc_info=True)
+        # Уведомляем второго пользователя (ошибку доставки залогирует outbox)
+        outbox.submit(SendMessage(
+            chat_id=target_id,
+            text=f"❗️ <b>@{message.from_user.username} сбросил стрик общения с вами</b>\n\n"
+            f"• Ваша серия была: {current_streak} {days_word}\n"
+            f"• История общения удалена\n\n"
+            "Начните общаться снова, чтобы создать новый стрик!",
+            parse_mode="HTML"
+        ), PRIORITY_NORMAL)
     else:
-        await message.answer(
+        outbox.submit(message.answer(
             "❌ Произошла ошибка при сбросе стрика. Попробуйте позже."
-        )
+        ))
 
 async def cmd_help(message: Message, command: Optional[CommandObject] = None):
     """Показывает справку по использованию бота"""
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     
     FREEZE_COST_PER_DAY = 1 
 
@@ -809,10 +903,10 @@ async def cmd_help(message: Message, command: Optional[CommandObject] = None):
     help_text_private = "\\n".join(help_text_private_lines)
 
     if message.chat.type == ChatType.PRIVATE:
-        await message.answer(help_text_private, parse_mode="HTML")
+        outbox.submit(message.answer(help_text_private, parse_mode="HTML"))
     else:
         # Существующий текст для групп, можно его тоже дополнить, если нужно
-        await message.answer(
+        outbox.submit(message.answer(
             "✨ <b>Streak Buddy в групповых чатах</b>\\n\\n"
             "🤝 <b>Как это работает:</b>",
             "• Бот автоматически отслеживает общение участников\\n"
@@ -829,14 +923,14 @@ async def cmd_help(message: Message, command: Optional[CommandObject] = None):
             "• Используйте веб-интерфейс для удобного просмотра\\n\\n"
             "Полный список команд, включая управление баллами, доступен в личном чате с ботом.",
             parse_mode="HTML"
-        )
+        ))
 
 async def cmd_streaks(message: Message, command: Optional[CommandObject] = None):
     """Показывает текущие серии общения пользователя"""
     # НЕОТЛОЖНОЕ ЛОГИРОВАНИЕ ВХОДА В ФУНКЦИЮ
     logger.critical(f"!!! CMD_STREAKS HANDLER ENTERED by {message.from_user.id} in chat {message.chat.id} !!!") 
     
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     user_id = message.from_user.id
     chat_id = message.chat.id
     username = message.from_user.username or str(user_id)
@@ -872,7 +966,7 @@ async def cmd_streaks(message: Message, command: Optional[CommandObject] = None)
                     "• Следите за прогрессом в веб-интерфейсе\n\n"
                     "Нажмите на кнопку ниже, чтобы открыть веб-интерфейс и увидеть все свои стрики:"
                 )
-                await message.answer(response_text, reply_markup=keyboard, parse_mode="HTML")
+                outbox.submit(message.answer(response_text, reply_markup=keyboard, parse_mode="HTML"))
             else:
                 response_text += (
                      "💫 <b>Как начать:</b>\n"
@@ -880,7 +974,7 @@ async def cmd_streaks(message: Message, command: Optional[CommandObject] = None)
                     "• Бот автоматически отследит ваши стрики в этой группе\n"
                     "• Следите за уведомлениями о достижениях"
                 )
-                await message.answer(response_text, parse_mode="HTML")
+                outbox.submit(message.answer(response_text, parse_mode="HTML"))
             return
 
         response_lines = []
@@ -919,32 +1013,32 @@ async def cmd_streaks(message: Message, command: Optional[CommandObject] = None)
         # Если streaks пуст, это сообщение не добавится, т.к. мы вышли раньше
         
         logger.info(f"CMD: /streaks - Sending response to {username} ({user_id}):\n{response_text}")
-        await message.answer(response_text, parse_mode="HTML")
+        outbox.submit(message.answer(response_text, parse_mode="HTML"))
 
     except Exception as e:
         logger.error(f"CMD: /streaks - Error processing /streaks for {username} ({user_id}): {e}", exc_info=True)
-        await message.answer("🚫 Ой, что-то пошло не так при показе ваших стриков. Попробуйте еще раз позже.")
+        outbox.submit(message.answer("🚫 Ой, что-то пошло не так при показе ваших стриков. Попробуйте еще раз позже."))
 
 # Новые команды для баланса и заморозки
 async def cmd_mybalance(message: Message):
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     user_id = message.from_user.id
     balance = await db.get_user_balance(user_id)
-    await message.answer(f"💰 Ваш текущий баланс: {balance} балл(ов).")
+    outbox.submit(message.answer(f"💰 Ваш текущий баланс: {balance} балл(ов)."))
 
 async def cmd_addbalance(message: Message, command: CommandObject):
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     if message.from_user.id != BOT_OWNER_ID:
-        await message.answer("⛔ Эту команду может использовать только владелец бота.")
+        outbox.submit(message.answer("⛔ Эту команду может использовать только владелец бота."))
         return
 
     if not command.args:
-        await message.answer("⚠️ Использование: /addbalance <user_id или @username> <количество>")
+        outbox.submit(message.answer("⚠️ Использование: /addbalance <user_id или @username> <количество>"))
         return
 
     args = command.args.split()
     if len(args) != 2:
-        await message.answer("⚠️ Использование: /addbalance <user_id или @username> <количество>")
+        outbox.submit(message.answer("⚠️ Использование: /addbalance <user_id или @username> <количество>"))
         return
 
     target_identifier, amount_str = args
@@ -952,7 +1046,7 @@ async def cmd_addbalance(message: Message, command: CommandObject):
     try:
         amount = int(amount_str)
     except ValueError:
-        await message.answer("❌ Неверный формат количества баллов.")
+        outbox.submit(message.answer("❌ Неверный формат количества баллов."))
         return
 
     target_user_id: Optional[int] = None
@@ -963,7 +1057,7 @@ async def cmd_addbalance(message: Message, command: CommandObject):
         target_user_id = await db.get_user_id_by_username(username)
         target_username_display = f"@{username}"
         if not target_user_id:
-            await message.answer(f"❌ Пользователь @{username} не найден в базе.")
+            outbox.submit(message.answer(f"❌ Пользователь @{username} не найден в базе."))
             return
     else:
         try:
@@ -976,32 +1070,32 @@ async def cmd_addbalance(message: Message, command: CommandObject):
                  await db.add_user(target_user_id, str(target_user_id)) # Убедимся, что юзер есть в users
                  logger.info(f"Admin: Adding balance to user by ID {target_user_id} who might not have a username or not started bot.")
         except ValueError:
-            await message.answer("❌ Неверный формат user_id или @username.")
+            outbox.submit(message.answer("❌ Неверный формат user_id или @username."))
             return
     
     if target_user_id is None: # На всякий случай, если что-то пошло не так с username
-        await message.answer(f"❌ Не удалось определить пользователя {target_identifier}.")
+        outbox.submit(message.answer(f"❌ Не удалось определить пользователя {target_identifier}."))
         return
 
-    if await db.update_user_balance(target_user_id, amount):
+    if await db.update_user_balance(target_user_id, amount, reason="owner_addbalance"):
         new_balance = await db.get_user_balance(target_user_id)
-        await message.answer(f"✅ Баланс пользователя {target_username_display} успешно пополнен на {amount} балл(ов).\nНовый баланс: {new_balance} балл(ов).")
+        outbox.submit(message.answer(f"✅ Баланс пользователя {target_username_display} успешно пополнен на {amount} балл(ов).\nНовый баланс: {new_balance} балл(ов)."))
     else:
-        await message.answer(f"❌ Не удалось обновить баланс для {target_username_display}.")
+        outbox.submit(message.answer(f"❌ Не удалось обновить баланс для {target_username_display}."))
 
 async def cmd_freezestreak(message: Message, command: CommandObject):
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     user_id = message.from_user.id
     
     FREEZE_COST_PER_DAY = 1
 
     if not command.args:
-        await message.answer(f"⚠️ Использование: /freezestreak @username <количество_дней>\\nСтоимость: {FREEZE_COST_PER_DAY} балл(а) за 1 день заморозки.")
+        outbox.submit(message.answer(f"⚠️ Использование: /freezestreak @username <количество_дней>\\nСтоимость: {FREEZE_COST_PER_DAY} балл(а) за 1 день заморозки."))
         return
 
     args = command.args.split()
     if len(args) != 2:
-        await message.answer(f"⚠️ Использование: /freezestreak @username <количество_дней>")
+        outbox.submit(message.answer(f"⚠️ Использование: /freezestreak @username <количество_дней>"))
         return
     
     target_username_str, days_to_freeze_str = args
@@ -1010,74 +1104,62 @@ async def cmd_freezestreak(message: Message, command: CommandObject):
     try:
         days_to_freeze = int(days_to_freeze_str)
         if days_to_freeze <= 0:
-            await message.answer("❌ Количество дней для заморозки должно быть положительным числом.")
+            outbox.submit(message.answer("❌ Количество дней для заморозки должно быть положительным числом."))
             return
         if days_to_freeze > 30: # Ограничение на одну операцию
-             await message.answer("❌ Максимальное количество дней для одной операции заморозки: 30.")
+             outbox.submit(message.answer("❌ Максимальное количество дней для одной операции заморозки: 30."))
              return
     except ValueError:
-        await message.answer("❌ Неверный формат количества дней.")
+        outbox.submit(message.answer("❌ Неверный формат количества дней."))
         return
 
     partner_id = await db.get_user_id_by_username(target_username)
     if not partner_id:
-        await message.answer(f"❌ Пользователь @{target_username} не найден. Убедитесь, что он начал диалог с ботом.")
+        outbox.submit(message.answer(f"❌ Пользователь @{target_username} не найден. Убедитесь, что он начал диалог с ботом."))
         return
         
     if user_id == partner_id:
-        await message.answer("❌ Вы не можете заморозить стрик с самим собой.")
+        outbox.submit(message.answer("❌ Вы не можете заморозить стрик с самим собой."))
         return
 
-    await db.add_streak_pair(user_id, partner_id) 
-
     cost = days_to_freeze * FREEZE_COST_PER_DAY
-    user_balance = await db.get_user_balance(user_id)
+    today = datetime.now(timezone.utc).date()
+
+    # Списание баллов, заморозка и запись в журнал - одна транзакция
+    purchase = await db.purchase_streak_freeze(user_id, partner_id, days_to_freeze, cost, today)
 
-    if user_balance < cost:
-        await message.answer(f"⚠️ Недостаточно баллов для заморозки.\\nТребуется: {cost} (за {days_to_freeze} дн.), у вас: {user_balance}.\\nПополните баланс или выберите меньший срок.")
+    if purchase.status == FREEZE_INSUFFICIENT_BALANCE:
+        outbox.submit(message.answer(f"⚠️ Недостаточно баллов для заморозки.\\nТребуется: {cost} (за {days_to_freeze} дн.), у вас: {purchase.balance}.\\nПополните баланс или выберите меньший срок."))
         return
 
-    today = datetime.now(timezone.utc).date()
-    current_freeze_end_date = await db.get_active_freeze(user_id, partner_id, today)
-    
-    start_date_for_new_freeze = current_freeze_end_date if current_freeze_end_date else today
-        
-    final_freeze_end_date = start_date_for_new_freeze + timedelta(days=days_to_freeze)
+    if purchase.status == FREEZE_LIMIT_EXCEEDED: 
+        outbox.submit(message.answer(f"⚠️ Общая длительность заморозки с @{target_username} не может превышать 60 дней от текущей даты. Текущий запрос на {days_to_freeze} дн. не выполнен."))
+        return
 
-    if (final_freeze_end_date - today).days > 60: 
-        await message.answer(f"⚠️ Общая длительность заморозки с @{target_username} не может превышать 60 дней от текущей даты. Текущий запрос на {days_to_freeze} дн. не выполнен.")
+    if purchase.status != FREEZE_OK:
+        outbox.submit(message.answer("❌ Не удалось активировать заморозку. Баллы не списаны. Попробуйте позже."))
         return
 
-    if await db.update_user_balance(user_id, -cost): 
-        if await db.add_streak_freeze(user_id, partner_id, final_freeze_end_date):
-            if current_freeze_end_date:
-                response_message_start = f"❄️ Заморозка с @{target_username} продлена до {final_freeze_end_date.strftime('%d.%m.%Y')}!"
-            else:
-                response_message_start = f"❄️ Стрик с @{target_username} успешно заморожен до {final_freeze_end_date.strftime('%d.%m.%Y')}!"
-            
-            await message.answer(f"{response_message_start}\nСписано {cost} балл(ов). Ваш новый баланс: {user_balance - cost}.")
-            
-            try:
-                partner_notification_action = 'продлил' if current_freeze_end_date else 'установил'
-                partner_notification_message = f"ℹ️ Пользователь @{message.from_user.username} {partner_notification_action} заморозку вашего общего стрика до {final_freeze_end_date.strftime('%d.%m.%Y')}."
-                await bot.send_message(partner_id, partner_notification_message)
-            except Exception as e:
-                logger.warning(f"Не удалось отправить уведомление о заморозке партнеру {partner_id}: {e}")
-        else:
-            await db.update_user_balance(user_id, cost) 
-            await message.answer("❌ Не удалось активировать заморозку. Баллы не списаны. Попробуйте позже.")
+    if purchase.previous_end_date:
+        response_message_start = f"❄️ Заморозка с @{target_username} продлена до {purchase.new_end_date.strftime('%d.%m.%Y')}!"
     else:
-        await message.answer("❌ Ошибка при списании баллов. Заморозка не активирована.")
+        response_message_start = f"❄️ Стрик с @{target_username} успешно заморожен до {purchase.new_end_date.strftime('%d.%m.%Y')}!"
+    
+    outbox.submit(message.answer(f"{response_message_start}\nСписано {cost} балл(ов). Ваш новый баланс: {purchase.balance}."))
+    
+    partner_notification_action = 'продлил' if purchase.previous_end_date else 'установил'
+    partner_notification_message = f"ℹ️ Пользователь @{message.from_user.username} {partner_notification_action} заморозку вашего общего стрика до {purchase.new_end_date.strftime('%d.%m.%Y')}."
+    outbox.submit(SendMessage(chat_id=partner_id, text=partner_notification_message), PRIORITY_NORMAL)
 
 async def cmd_getbalance(message: Message, command: CommandObject):
     """(Только для админа) Проверяет баланс указанного пользователя."""
-    await reset_daily_caches_if_new_day()
+    reset_daily_caches_if_new_day()
     if message.from_user.id != BOT_OWNER_ID:
-        await message.answer("⛔ Эту команду может использовать только владелец бота.")
+        outbox.submit(message.answer("⛔ Эту команду может использовать только владелец бота."))
         return
 
     if not command.args:
-        await message.answer("⚠️ Использование: /getbalance <user_id или @username>")
+        outbox.submit(message.answer("⚠️ Использование: /getbalance <user_id или @username>"))
         return
 
     target_identifier = command.args.strip()
@@ -1089,7 +1171,7 @@ async def cmd_getbalance(message: Message, command: CommandObject):
         target_user_id = await db.get_user_id_by_username(username)
         target_username_display = f"@{username}"
         if not target_user_id:
-            await message.answer(f"❌ Пользователь @{username} не найден в базе.")
+            outbox.submit(message.answer(f"❌ Пользователь @{username} не найден в базе."))
             return
     else:
         try:
@@ -1100,31 +1182,63 @@ async def cmd_getbalance(message: Message, command: CommandObject):
                 target_username_display = f"@{fetched_username} (ID: {target_user_id})"
             # Если юзернейма нет, но ID валидный, все равно работаем, если он есть в базе
             elif not await db.get_username_by_id(target_user_id): # Проверяем, существует ли пользователь с таким ID
-                 await message.answer(f"❌ Пользователь с ID {target_user_id} не найден в базе.")
+                 outbox.submit(message.answer(f"❌ Пользователь с ID {target_user_id} не найден в базе."))
                  return
         except ValueError:
-            await message.answer("❌ Неверный формат user_id. Укажите ID числом или @username.")
+            outbox.submit(message.answer("❌ Неверный формат user_id. Укажите ID числом или @username."))
             return
     
     if target_user_id is None: # На всякий случай, если что-то пошло не так с username
-        await message.answer(f"❌ Не удалось определить пользователя {target_identifier}.")
+        outbox.submit(message.answer(f"❌ Не удалось определить пользователя {target_identifier}."))
         return
 
     balance = await db.get_user_balance(target_user_id)
-    await message.answer(f"💰 Баланс пользователя {target_username_display}: {balance} балл(ов).")
+    outbox.submit(message.answer(f"💰 Баланс пользователя {target_username_display}: {balance} балл(ов)."))
 
-async def main():
-    """Главная функция запуска бота"""
-    global current_bot_date
-    current_bot_date = datetime.now(timezone.utc).date()
-    logger.info(f"Бот запускается. Текущая дата: {current_bot_date}")
+# Единственный ответ пользователю, если транзакция обработчика откатена
+TRANSACTION_ABORTED_TEXT = "❌ Не удалось сохранить изменения. Попробуйте еще раз позже."
+
+
+class TransactionMiddleware(BaseMiddleware):
+    """Каждый обработчик сообщения, команды или колбэка выполняется в одной
+    db.transaction(): все его записи фиксируются одним COMMIT или откатываются вместе.
+    Писатель берется только при первой записи, поэтому читающие обработчики
+    друг друга не блокируют.
+
+    Сообщения, которые обработчик ставит в outbox, отправляются только после COMMIT:
+    при откате пользователь получает одно сообщение об ошибке, а не ответы об успехе."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        with outbox.holding() as held:
+            try:
+                async with db.transaction() as tx:
+                    tx.after_commit(held.release)
+                    return await handler(event, data)
+            except TransactionAborted:
+                dropped = held.drop()
+                logger.error(f"Транзакция обработчика {type(event).__name__} откатена, изменения не сохранены "
+                             f"(не отправлено сообщений: {dropped}).")
+        if isinstance(event, types.CallbackQuery):
+            outbox.submit(event.answer(TRANSACTION_ABORTED_TEXT, show_alert=True))
+        else:
+            outbox.submit(event.answer(TRANSACTION_ABORTED_TEXT))
 
+
+
+def create_dispatcher() -> Dispatcher:
+    """Создает Dispatcher и регистрирует все хендлеры."""
     # Инициализация Dispatcher с MemoryStorage (хорошая практика)
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
-
-    await db.init()
-    await setup_bot_commands() # Установка команд в меню Telegram
+    dp.update.outer_middleware(update_order)
+    # Обработчик сообщения, команды или колбэка - одна транзакция БД
+    dp.message.middleware(TransactionMiddleware())
+    dp.callback_query.middleware(TransactionMiddleware())
 
     # РЕГИСТРАЦИЯ ХЕНДЛЕРОВ
     # Командные хендлеры регистрируем ПЕРВЫМИ
@@ -1152,8 +1266,11 @@ async def main():
     dp.message.register(handle_message) 
 
     logger.info("Хендлеры зарегистрированы.")
+    return dp
 
-    # Запускаем веб-сервер
+
+def create_web_app() -> web.Application:
+    """Веб-сервер WebApp API с настроенным CORS."""
     app = web.Application()
 
     # Настройка CORS
@@ -1172,20 +1289,157 @@ async def main():
 
     for route in list(app.router.routes()): # Теперь итерируемся по зарегистрированным маршрутам
         cors.add(route) # Применяем конфигурацию CORS по умолчанию (из defaults) к каждому маршруту
-    
+    return app
+
+
+async def start_web_app(app: web.Application) -> web.AppRunner:
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, 'localhost', 8080)
     await site.start()
     logger.info("Веб-сервер запущен на http://localhost:8080")
-    
+    return runner
+
+
+async def set_webhook(dp: Dispatcher):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_CONCURRENT_UPDATES, 100),
+        )
+        logger.info(f"Webhook установлен: {WEBHOOK_URL} -> {WEBHOOK_PATH}")
+    else:
+        # Локальная проверка: апдейты можно слать POST-запросом с JSON на WEBHOOK_PATH
+        logger.info(f"WEBHOOK_URL не задан, webhook в Telegram не регистрируется. Апдейты принимаются на http://localhost:8080{WEBHOOK_PATH}")
+
+
+async def start_services(owns_chat: Optional[Callable[[int], bool]] = lambda chat_id: True):
+    """БД, очередь исходящих сообщений и планировщик смены дня (в каждом процессе свои).
+    Состояние текущего дня для чатов, которые отбирает owns_chat, восстанавливается из БД,
+    поэтому после перезапуска подтвержденные пары не обрабатываются и не объявляются повторно.
+    owns_chat=None - процесс не обрабатывает группы, состояние дня не загружается."""
+    global current_bot_date, rollover_task
+    current_bot_date = datetime.now(timezone.utc).date()
+    logger.info(f"Бот запускается. Текущая дата: {current_bot_date}")
+    await db.init()
+    if owns_chat is not None:
+        restored = daily_state.rehydrate(current_bot_date, await db.load_daily_state(current_bot_date), owns_chat)
+        logger.info(f"Восстановлено состояние дня для {restored} чатов.")
+    else:
+        daily_state.reset(current_bot_date)
+    outbox.start()
+    rollover_task = asyncio.create_task(daily_rollover_scheduler())
+
+
+async def stop_services():
+    rollover_task.cancel()
+    await streak_notifier.close()
+    await outbox.close()
+    logger.info(f"Outbox: {outbox.metrics()}")
+    logger.info(f"Очередность апдейтов по чатам: {update_order.stats()}")
+    logger.info(f"Последнее ежедневное обслуживание: {rollover_stats}")
+    await bot.session.close()
+    logger.info("Сессия бота закрыта.")
+    await db.close()
+
+
+def run_worker_process(worker_index: int, worker_count: int, updates):
+    """Точка входа процесса-воркера (см. workers.WorkerSupervisor)."""
+    asyncio.run(worker_main(worker_index, worker_count, updates))
+
+
+async def worker_main(worker_index: int, worker_count: int, updates):
+    global outbox, daily_maintenance_enabled
+    # Обслуживание БД при смене дня выполняет только воркер 0
+    daily_maintenance_enabled = worker_index == 0
+    # Общий лимит Telegram делится между воркерами
+    outbox = OutboundDispatcher(bot, global_rate=TELEGRAM_GLOBAL_RATE / worker_count)
+    dp = create_dispatcher()
+    await start_services(owns_chat=lambda chat_id: chat_id % worker_count == worker_index)
+    logger.info(f"Воркер {worker_index}/{worker_count} готов к обработке апдейтов.")
+    try:
+        await consume_updates(updates, lambda update: dp.feed_raw_update(bot, update),
+                              max_concurrent=WEBHOOK_MAX_CONCURRENT_UPDATES)
+    finally:
+        await stop_services()
+
+
+async def run_supervisor():
+    """Режим нескольких процессов: супервизор принимает апдейты (polling или webhook)
+    и раздает их WORKER_PROCESSES воркерам по chat_id; сам обслуживает WebApp API."""
+    global daily_maintenance_enabled
+    daily_maintenance_enabled = False
+    supervisor = WorkerSupervisor(run_worker_process, WORKER_PROCESSES)
+    # Миграции выполняются здесь, до запуска воркеров. Группы обрабатывают воркеры,
+    # поэтому состояние дня супервизору не нужно.
+    await start_services(owns_chat=None)
+    supervisor.start()
+    dp = create_dispatcher() # Только для списка типов апдейтов и обработчика вебхука; апдейты обрабатывают воркеры
+    await setup_bot_commands() # Установка команд в меню Telegram
+
+    app = create_web_app()
+    if UPDATE_MODE == "webhook":
+        supervisor.webhook_handler(
+            dp,
+            bot,
+            secret_token=WEBHOOK_SECRET,
+            max_concurrent_updates=WEBHOOK_MAX_CONCURRENT_UPDATES,
+        ).register(app, path=WEBHOOK_PATH)
+    runner = await start_web_app(app)
+
+    try:
+        if UPDATE_MODE == "webhook":
+            await set_webhook(dp)
+            await asyncio.Event().wait()
+        else:
+            logger.info(f"Запуск polling с {WORKER_PROCESSES} воркерами...")
+            await bot.delete_webhook()
+            await supervisor.poll(bot, dp.resolve_used_update_types())
+    finally:
+        await runner.cleanup()
+        await supervisor.stop()
+        await stop_services()
+
+
+async def main():
+    """Главная функция запуска бота"""
+    if WORKER_PROCESSES > 1:
+        await run_supervisor()
+        return
+
+    dp = create_dispatcher()
+    await start_services()
+    await setup_bot_commands() # Установка команд в меню Telegram
+
+    # Запускаем веб-сервер
+    app = create_web_app()
+
+    # В режиме webhook апдейты принимает тот же веб-сервер (без CORS - это не API для браузера)
+    if UPDATE_MODE == "webhook":
+        webhook_handler = BoundedRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            max_concurrent_updates=WEBHOOK_MAX_CONCURRENT_UPDATES,
+        )
+        webhook_handler.register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    runner = await start_web_app(app)
+
     # Запускаем бота
-    logger.info("Запуск polling...")
     try:
-        await dp.start_polling(bot)
+        if UPDATE_MODE == "webhook":
+            await set_webhook(dp)
+            await asyncio.Event().wait()
+        else:
+            logger.info("Запуск polling...")
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
-        await bot.session.close()
-        logger.info("Сессия бота закрыта.")
+        await runner.cleanup()
+        await stop_services()
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,269 @@
+import asyncio
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from database import DailySnapshot, pair_key
+
+# Биты направлений, как в pair_daily_activity.spoke_mask:
+# 1 - писал user_lo, 2 - писал user_hi, 3 - пара подтверждена
+SPOKE_LO = 1
+SPOKE_HI = 2
+SPOKE_BOTH = SPOKE_LO | SPOKE_HI
+# Уведомление о стрике пары за сегодня уже отправлено
+NOTIFIED = 4
+
+
+class ChatDayState:
+    """Состояние одного чата за текущий день: кто писал, какие направления пар
+    уже записаны в БД и кому отправлено уведомление.
+    Позволяет без обращения к БД понять, меняет ли что-то новое сообщение.
+
+    Хранится в массивах, а не в set/dict: отсортированный array('q') активных
+    пользователей и параллельные массивы пар (user_lo, user_hi, флаги),
+    упорядоченные по (user_lo, user_hi). 17 байт на пару и 8 на пользователя."""
+
+    __slots__ = ("_users", "_lo", "_hi", "_flags", "_confirmed")
+
+    def __init__(self):
+        self._users = array('q')
+        self._lo = array('q')
+        self._hi = array('q')
+        self._flags = array('B')
+        self._confirmed = 0
+
+    def _find(self, lo: int, hi: int) -> Tuple[int, bool]:
+        """Позиция пары в массивах и признак, что она там есть."""
+        start = bisect_left(self._lo, lo)
+        end = bisect_right(self._lo, lo, start)
+        i = bisect_left(self._hi, hi, start, end)
+        return i, i < end and self._hi[i] == hi
+
+    def _slot(self, lo: int, hi: int) -> int:
+        i, found = self._find(lo, hi)
+        if not found:
+            self._lo.insert(i, lo)
+            self._hi.insert(i, hi)
+            self._flags.insert(i, 0)
+        return i
+
+    def _pair_flags(self, user_id: int, partner_id: int) -> int:
+        i, found = self._find(*pair_key(user_id, partner_id))
+        return self._flags[i] if found else 0
+
+    def is_active(self, user_id: int) -> bool:
+        i = bisect_left(self._users, user_id)
+        return i < len(self._users) and self._users[i] == user_id
+
+    def add_active(self, user_id: int):
+        i = bisect_left(self._users, user_id)
+        if i == len(self._users) or self._users[i] != user_id:
+            self._users.insert(i, user_id)
+
+    def observe(self, user_id: int) -> List[int]:
+        """Отмечает пользователя активным и возвращает партнеров, пары с которыми
+        еще не подтверждены сегодня. Пустой список - сообщение ничего не меняет."""
+        if self.is_active(user_id):
+            users = len(self._users)
+            if self._confirmed == users * (users - 1) // 2:
+                return []  # Все пары чата уже подтверждены
+        else:
+            self.add_active(user_id)
+        return [
+            partner_id for partner_id in self._users
+            if partner_id != user_id and not self.is_confirmed(user_id, partner_id)
+        ]
+
+    def is_confirmed(self, user_id: int, partner_id: int) -> bool:
+        return self._pair_flags(user_id, partner_id) & SPOKE_BOTH == SPOKE_BOTH
+
+    def mark(self, user_id: int, partner_id: int) -> bool:
+        """Запоминает записанное направление user_id -> partner_id.
+        Возвращает True, если пара только что стала подтвержденной."""
+        i = self._slot(*pair_key(user_id, partner_id))
+        before = self._flags[i]
+        after = before | (SPOKE_LO if user_id < partner_id else SPOKE_HI)
+        self._flags[i] = after
+        confirmed = before & SPOKE_BOTH != SPOKE_BOTH and after & SPOKE_BOTH == SPOKE_BOTH
+        if confirmed:
+            self._confirmed += 1
+        return confirmed
+
+    def confirm(self, user_id: int, partner_id: int) -> bool:
+        """Запоминает, что оба направления пары записаны.
+        Возвращает True, если пара подтверждена этим вызовом."""
+        first = self.mark(user_id, partner_id)
+        return self.mark(partner_id, user_id) or first
+
+    def is_notified(self, user_id: int, partner_id: int) -> bool:
+        return bool(self._pair_flags(user_id, partner_id) & NOTIFIED)
+
+    def set_notified(self, user_id: int, partner_id: int):
+        i = self._slot(*pair_key(user_id, partner_id))
+        self._flags[i] |= NOTIFIED
+
+    def forget_pair(self, user_id: int, partner_id: int) -> bool:
+        """Снимает с пары отметки направлений и уведомления (после сброса стрика).
+        Возвращает True, если пара была в состоянии чата."""
+        i, found = self._find(*pair_key(user_id, partner_id))
+        if not found:
+            return False
+        if self._flags[i] & SPOKE_BOTH == SPOKE_BOTH:
+            self._confirmed -= 1
+        self._flags[i] = 0
+        return True
+
+    @property
+    def active_count(self) -> int:
+        return len(self._users)
+
+    @property
+    def pair_count(self) -> int:
+        return len(self._lo)
+
+    def nbytes(self) -> int:
+        """Объем данных в массивах (без накладных расходов самих объектов)."""
+        return sum(
+            len(buffer) * buffer.itemsize
+            for buffer in (self._users, self._lo, self._hi, self._flags)
+        )
+
+
+# Примерные накладные расходы на один чат: объект, четыре пустых array и запись в OrderedDict
+CHAT_OVERHEAD_BYTES = 600
+
+
+class DailyPairState:
+    """Хранилище ChatDayState по чатам; сбрасывается при смене дня.
+
+    Общий объем ограничен max_bytes: при превышении вытесняются давно не
+    использовавшиеся чаты (LRU). Все, что хранится в ChatDayState, есть и в БД,
+    поэтому вытесненный чат при следующем обращении (get_chat) загружается
+    заново через loader(day, chat_id)."""
+
+    # Как часто (в обращениях к чатам) пересчитывать общий объем
+    TRIM_EVERY = 256
+
+    def __init__(self, loader: Optional[Callable[[date, int], Awaitable[DailySnapshot]]] = None,
+                 max_bytes: int = 64 * 1024 * 1024):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.day: Optional[date] = None
+        self.chats: "OrderedDict[int, ChatDayState]" = OrderedDict()
+        self._evicted: Set[int] = set()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._accesses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def chat(self, chat_id: int) -> ChatDayState:
+        """Состояние чата из памяти (новое, если его нет); не подгружает вытесненные."""
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = ChatDayState()
+        else:
+            self.chats.move_to_end(chat_id)
+        self._accesses += 1
+        if self._accesses % self.TRIM_EVERY == 0:
+            self.trim(keep=chat_id)
+        return state
+
+    async def get_chat(self, chat_id: int) -> ChatDayState:
+        """Состояние чата; вытесненный сегодня чат сначала восстанавливается из БД."""
+        if chat_id not in self._evicted or self.loader is None:
+            return self.chat(chat_id)
+        loading = self._loading.get(chat_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            day = self.day
+            snapshot = await self.loader(day, chat_id)
+            if day == self.day:
+                self._evicted.discard(chat_id)
+                self.chats.pop(chat_id, None)
+                self._apply(snapshot, lambda owner: owner == chat_id)
+                self.reloads += 1
+            state = self.chat(chat_id)
+            future.set_result(state)
+            return state
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # ждущих может и не быть
+            raise
+        finally:
+            self._loading.pop(chat_id, None)
+
+    def forget_pair(self, user_id: int, partner_id: int) -> int:
+        """Сбрасывает пару во всех чатах в памяти: следующее сообщение снова ее обработает.
+        Вытесненные чаты при загрузке читают БД, где данные пары уже удалены.
+        Возвращает число чатов, где пара была."""
+        return sum(state.forget_pair(user_id, partner_id) for state in self.chats.values())
+
+    def reset(self, day: date):
+        self.day = day
+        self.chats.clear()
+        self._evicted.clear()
+
+    def rehydrate(self, day: date, snapshot: DailySnapshot, owns_chat: Callable[[int], bool] = lambda chat_id: True) -> int:
+        """Восстанавливает состояние дня из БД (после перезапуска): активных пользователей,
+        направления - по messages, отправленные уведомления.
+        owns_chat отбирает чаты этого процесса. Возвращает число восстановленных чатов."""
+        self.reset(day)
+        self._apply(snapshot, owns_chat)
+        self.trim()
+        return len(self.chats)
+
+    def _apply(self, snapshot: DailySnapshot, owns_chat: Callable[[int], bool]):
+        for chat_id, user_id in snapshot.active:
+            if owns_chat(chat_id):
+                self.chats.setdefault(chat_id, ChatDayState()).add_active(user_id)
+        for chat_id, user_id, partner_id in snapshot.marks:
+            if owns_chat(chat_id):
+                state = self.chats.setdefault(chat_id, ChatDayState())
+                state.add_active(user_id)
+                state.add_active(partner_id)
+                state.mark(user_id, partner_id)
+        for chat_id, user_lo, user_hi in snapshot.notified:
+            if owns_chat(chat_id):
+                self.chats.setdefault(chat_id, ChatDayState()).set_notified(user_lo, user_hi)
+
+    def nbytes(self) -> int:
+        return sum(state.nbytes() + CHAT_OVERHEAD_BYTES for state in self.chats.values())
+
+    def trim(self, keep: Optional[int] = None) -> int:
+        """Вытесняет самые давние чаты, пока объем больше max_bytes. Возвращает число вытесненных."""
+        total = self.nbytes()
+        evicted = 0
+        while total > self.max_bytes and len(self.chats) > 1:
+            chat_id, state = next(iter(self.chats.items()))
+            if chat_id == keep:
+                self.chats.move_to_end(chat_id)
+                continue
+            del self.chats[chat_id]
+            self._evicted.add(chat_id)
+            total -= state.nbytes() + CHAT_OVERHEAD_BYTES
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def memory_report(self, limit: int = 20) -> List[Tuple[int, int, int, int]]:
+        """Самые тяжелые чаты: (chat_id, байт, активных пользователей, пар)."""
+        report = [
+            (chat_id, state.nbytes() + CHAT_OVERHEAD_BYTES, state.active_count, state.pair_count)
+            for chat_id, state in self.chats.items()
+        ]
+        report.sort(key=lambda row: row[1], reverse=True)
+        return report[:limit]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self.chats),
+            "bytes": self.nbytes(),
+            "evicted_chats": len(self._evicted),
+            "evictions": self.evictions,
+            "reloads": self.reloads,
+        }
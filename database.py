@@ -1,23 +1,535 @@
 import aiosqlite
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import date, datetime, timezone
-from typing import List, Tuple, Optional, Any
+from typing import List, Tuple, Optional, Any, AsyncIterator, Dict, NamedTuple, Iterable
 import logging
+import time
+from collections import OrderedDict
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+from pairset import PairSet
 
 # logger = logging.getLogger(__name__) # Используем глобальный логгер из bot.py или настраиваем свой
 # Для простоты пока оставим так, но лучше передавать logger или использовать getLogger(__name__)
 
+# Версионированный набор индексов для горячих запросов. При любом изменении
+# списка увеличьте INDEX_SET_VERSION: init() создаст новые индексы и удалит
+# устаревшие idx_*, которых больше нет в списке.
+INDEX_SET_VERSION = 5
+INDEXES = {
+    # get_user_id_by_username: поиск без учета регистра
+    "idx_users_username_nocase": "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)",
+    # compact_messages: выборка сырых сообщений старше окна хранения
+    "idx_messages_chat_date": "CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages(chat_date)",
+    # fold_daily_activity: дневные строки сводки старше окна хранения
+    "idx_pair_daily_activity_day": "CREATE INDEX IF NOT EXISTS idx_pair_daily_activity_day ON pair_daily_activity(day)",
+    # reset_inactive_streaks: только активные пары, покрывающий индекс
+    "idx_pair_streaks_active": (
+        "CREATE INDEX IF NOT EXISTS idx_pair_streaks_active "
+        "ON pair_streaks(last_streak_date, user_lo, user_hi, streak_count) WHERE streak_count > 0"
+    ),
+    # sweep_expired_freezes: удаление истекших заморозок по диапазону дат
+    "idx_pair_freezes_end": "CREATE INDEX IF NOT EXISTS idx_pair_freezes_end ON pair_freezes(freeze_end_date)",
+    # Вторая половина представления streak_pairs (поиск по user_hi)
+    "idx_pair_streaks_hi": "CREATE INDEX IF NOT EXISTS idx_pair_streaks_hi ON pair_streaks(user_hi, user_lo)",
+}
+
+# Ежедневный сброс: одна выборка по idx_pair_streaks_active (диапазон по дате)
+# с анти-join по действующим заморозкам. Параметры: (вчера, сегодня).
+RESET_INACTIVE_STREAKS_SQL = """
+    UPDATE pair_streaks SET streak_count = 0
+    WHERE streak_count > 0
+      AND last_streak_date < ?
+      AND NOT EXISTS (
+          SELECT 1 FROM pair_freezes f
+          WHERE f.user_lo = pair_streaks.user_lo AND f.user_hi = pair_streaks.user_hi
+            AND f.freeze_end_date >= ?
+      )
+"""
+
+# Стрики пользователя одним запросом: обе половины pair_streaks (пользователь
+# может быть user_lo или user_hi), имя партнера и действующая заморозка.
+# Параметры: (user_id, user_id, сегодня).
+_USER_STREAKS_TEMPLATE = """
+    SELECT u.user_id, u.username, ps.streak_count, f.freeze_end_date
+    FROM (
+        SELECT user_hi AS partner_id, user_lo, user_hi, streak_count
+        FROM pair_streaks WHERE user_lo = ? AND streak_count > 0
+        UNION ALL
+        SELECT user_lo AS partner_id, user_lo, user_hi, streak_count
+        FROM pair_streaks WHERE user_hi = ? AND streak_count > 0
+    ) ps
+    JOIN users u ON u.user_id = ps.partner_id
+    LEFT JOIN pair_freezes f
+        ON f.user_lo = ps.user_lo AND f.user_hi = ps.user_hi AND f.freeze_end_date >= ?
+    {group_filter}
+    ORDER BY ps.streak_count DESC
+"""
+USER_STREAKS_SQL = _USER_STREAKS_TEMPLATE.format(group_filter="")
+# Групповой контекст: только партнеры, с которыми было общение в этом чате
+# (по сводке pair_daily_activity). Дополнительный параметр: (chat_id,).
+USER_STREAKS_IN_CHAT_SQL = _USER_STREAKS_TEMPLATE.format(group_filter="""
+    WHERE EXISTS (
+        SELECT 1 FROM pair_daily_activity a
+        WHERE a.user_lo = ps.user_lo AND a.user_hi = ps.user_hi AND a.chat_id = ?
+    )""")
+
+# Дневные строки pair_daily_activity старше окна хранения сворачиваются в одну строку
+# на (пара, чат) с этим днем: после этого остается только факт общения в чате.
+ACTIVITY_FOLDED_DAY = -1
+FOLD_ACTIVITY_BATCH_SQL = """
+    SELECT user_lo, user_hi, chat_id, day, spoke_mask FROM pair_daily_activity
+    WHERE day >= 0 AND day < ? LIMIT ?
+"""
+
+# Слияние сырых сообщений в pair_daily_activity: бит 1 - писал user_lo, бит 2 - user_hi.
+# Подставляется условие отбора строк messages.
+_ROLLUP_MESSAGES_TEMPLATE = """
+    INSERT INTO pair_daily_activity (user_lo, user_hi, chat_id, day, spoke_mask)
+    SELECT MIN(user_id, partner_id), MAX(user_id, partner_id), chat_id_context, chat_date,
+           MAX(user_id < partner_id) | (MAX(user_id > partner_id) << 1)
+    FROM messages
+    WHERE user_id <> partner_id AND chat_id_context IS NOT NULL AND chat_date IS NOT NULL AND ({condition})
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (user_lo, user_hi, chat_id, day) DO UPDATE SET spoke_mask = spoke_mask | excluded.spoke_mask
+"""
+
+# Теплый перезапуск: отметки за день
+DAILY_MARKS_SQL = "SELECT chat_id_context, user_id, partner_id FROM messages WHERE chat_date = ?"
+# То же для одного чата (восстановление вытесненного из памяти чата)
+DAILY_CHAT_MARKS_SQL = "SELECT chat_id_context, user_id, partner_id FROM messages WHERE chat_date = ? AND chat_id_context = ?"
+
+# Горячие запросы и индекс, который обязан быть в их плане (EXPLAIN QUERY PLAN).
+# Проверяется в init() через check_query_plans(), чтобы изменение схемы или
+# запроса не вернуло полное сканирование таблицы незаметно.
+HOT_QUERY_PLANS = {
+    "get_user_id_by_username": (
+        "SELECT user_id FROM users WHERE username = ? COLLATE NOCASE",
+        ("username",),
+        "idx_users_username_nocase",
+    ),
+    "get_user_streaks.group_filter": (
+        USER_STREAKS_IN_CHAT_SQL,
+        (1, 1, 0, 3),
+        "SEARCH a USING PRIMARY KEY",
+    ),
+    "get_last_chat_date": (
+        "SELECT last_streak_date FROM pair_streaks WHERE user_lo = ? AND user_hi = ?",
+        (1, 2),
+        "sqlite_autoindex_pair_streaks_1",  # PRIMARY KEY (user_lo, user_hi)
+    ),
+    "check_both_marked": (
+        "SELECT spoke_mask FROM pair_daily_activity WHERE user_lo = ? AND user_hi = ? AND chat_id = ? AND day = ?",
+        (1, 2, 3, 0),
+        "SEARCH pair_daily_activity USING PRIMARY KEY",
+    ),
+    "sweep_expired_freezes": (
+        "DELETE FROM pair_freezes WHERE freeze_end_date < ?",
+        (0,),
+        "idx_pair_freezes_end",
+    ),
+    "fold_daily_activity": (
+        FOLD_ACTIVITY_BATCH_SQL,
+        (0, 1),
+        "idx_pair_daily_activity_day",
+    ),
+    "compact_messages": (
+        "SELECT id FROM messages WHERE chat_date < ? LIMIT ?",
+        (0, 1),
+        "idx_messages_chat_date",
+    ),
+    "reset_inactive_streaks": (
+        RESET_INACTIVE_STREAKS_SQL,
+        (0, 1),
+        "idx_pair_streaks_active",
+    ),
+    "load_daily_state.marks": (
+        DAILY_MARKS_SQL,
+        (0,),
+        "idx_messages_chat_date",
+    ),
+    "get_user_streaks.partners": (
+        USER_STREAKS_SQL,
+        (1, 1, 0),
+        "idx_pair_streaks_hi",
+    ),
+}
+
+
+# Все даты (last_streak_date, freeze_end_date, chat_date, mark_date) хранятся
+# целым номером дня от 1970-01-01: сравнения и арифметика стриков - целочисленные,
+# без strptime/isoformat.
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def date_to_day(value: date) -> int:
+    """date -> номер дня от 1970-01-01."""
+    return value.toordinal() - _EPOCH_ORDINAL
+
+
+def day_to_date(day: int) -> date:
+    """Номер дня от 1970-01-01 -> date."""
+    return date.fromordinal(day + _EPOCH_ORDINAL)
+
+
+# Столбцы-даты, которые миграция переводит из ISO-строк в номера дней
+DAY_COLUMNS = (
+    ("pair_streaks", "last_streak_date"),
+    ("pair_freezes", "freeze_end_date"),
+    ("messages", "chat_date"),
+    ("webapp_daily_marks", "mark_date"),
+)
+
+
+def pair_key(user_a: int, user_b: int) -> Tuple[int, int]:
+    """Канонический ключ пары (min, max) для pair_streaks/pair_freezes."""
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+# Результат purchase_streak_freeze
+FREEZE_OK = "ok"
+FREEZE_INSUFFICIENT_BALANCE = "insufficient_balance"
+FREEZE_LIMIT_EXCEEDED = "limit_exceeded"
+FREEZE_ERROR = "error"
+
+
+class DailySnapshot(NamedTuple):
+    """Состояние дня из БД для восстановления кешей после перезапуска."""
+    active: List[Tuple[int, int]]                # (chat_id, user_id) - писавшие в этот день
+    marks: List[Tuple[int, int, int]]            # (chat_id, user_id, partner_id)
+    notified: List[Tuple[int, int, int]]         # (chat_id, user_lo, user_hi)
+
+
+class FreezePurchase(NamedTuple):
+    status: str
+    previous_end_date: Optional[date]  # действовавшая заморозка, которую продлили
+    new_end_date: Optional[date]
+    balance: Optional[int]             # новый баланс (или текущий при нехватке баллов)
+
+
+@dataclass
+class StorageProfile:
+    """Настройки хранилища SQLite: режим журнала, прагмы и число соединений для чтения."""
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024  # байт
+    cache_size_kib: int = 64 * 1024      # PRAGMA cache_size = -N (в KiB)
+    busy_timeout_ms: int = 5000
+    read_pool_size: int = 4
+    # Сырые строки messages старше этого окна сворачиваются в pair_daily_activity и удаляются,
+    # а дневные строки pair_daily_activity - в одну строку на пару и чат
+    message_retention_days: int = 30
+    # В БД пишут несколько процессов: имя из индекса _known_users могло устареть
+    # (его сменил другой процесс), поэтому add_user перепроверяет совпадение чтением
+    verify_known_users: bool = False
+    # Кэш соответствия user_id <-> username (см. IdentityCache)
+    identity_cache_size: int = 10000
+    identity_cache_ttl_s: float = 600.0
+
+
+class IdentityCache:
+    """Ограниченный двунаправленный кэш user_id <-> username с TTL и LRU-вытеснением.
+    Поиск по username без учета регистра, как и в get_user_id_by_username."""
+
+    def __init__(self, max_size: int, ttl_s: float):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        # user_id -> (username, истекает_в); порядок = порядок использования (LRU)
+        self._by_id: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        # username.lower() -> user_id
+        self._by_name: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, user_id: int):
+        entry = self._by_id.pop(user_id, None)
+        if entry is not None:
+            key = entry[0].lower()
+            if self._by_name.get(key) == user_id:
+                del self._by_name[key]
+
+    def _live_username(self, user_id: int) -> Optional[str]:
+        entry = self._by_id.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self._drop(user_id)
+            return None
+        self._by_id.move_to_end(user_id)
+        return entry[0]
+
+    def get_username(self, user_id: int) -> Optional[str]:
+        username = self._live_username(user_id)
+        if username is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return username
+
+    def get_user_id(self, username: str) -> Optional[int]:
+        user_id = self._by_name.get(username.lower())
+        # Запись по имени действительна, только пока жива запись по id
+        if user_id is not None and self._live_username(user_id) is not None:
+            self.hits += 1
+            return user_id
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, username: str):
+        if self.max_size <= 0:
+            return
+        self._drop(user_id)
+        self._by_id[user_id] = (username, time.monotonic() + self.ttl_s)
+        self._by_name[username.lower()] = user_id
+        while len(self._by_id) > self.max_size:
+            oldest_id = next(iter(self._by_id))
+            self._drop(oldest_id)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._by_id), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class TransactionAborted(Exception):
+    """Операция внутри Database.transaction() завершилась ошибкой; вся транзакция откатена."""
+
+
+class Transaction:
+    """Единица работы: все записи методов Database внутри `async with db.transaction()`
+    идут через одно соединение писателя и фиксируются одним COMMIT в конце.
+    Писатель берется при первой записи, поэтому блок, который только читает,
+    не блокирует другие апдейты."""
+
+    def __init__(self):
+        # Соединение писателя; None, пока в транзакции ничего не записано
+        self.connection: Optional[aiosqlite.Connection] = None
+        # Задача, открывшая транзакцию: дочерние задачи (фоновые, созданные внутри блока)
+        # к ней не присоединяются и работают со своими соединениями
+        self.owner = asyncio.current_task()
+        self.finished = False
+        # Вложенный метод поймал и залогировал ошибку - коммитить нельзя
+        self.rollback_only = False
+        self._after_commit: List[Any] = []
+
+    def after_commit(self, callback):
+        """Откладывает обновление in-process кэшей до успешного COMMIT."""
+        self._after_commit.append(callback)
+
+
 class Database:
-    def __init__(self, db_name: str = "streak_bot.db"):
+    def __init__(self, db_name: str = "streak_bot.db", profile: Optional[StorageProfile] = None):
         self.db_name = db_name
+        self.profile = profile or StorageProfile()
         self.logger = logging.getLogger(__name__ + ".database") # Логгер для этого класса
+        # Одно соединение для всех изменений (SQLite все равно допускает одного писателя)
+        # и пул read-only соединений. В режиме WAL читатели не ждут писателя.
+        # Открываются в init() и закрываются в close().
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._read_pool: Optional[asyncio.Queue] = None
+        self._readers: List[aiosqlite.Connection] = []
+        # Соединение, которое уже держит текущая задача. Вложенные вызовы методов
+        # (например, update_user_balance -> get_user_balance) переиспользуют его,
+        # а не берут второе соединение.
+        self._bound_connection: ContextVar[Optional[aiosqlite.Connection]] = ContextVar(
+            f"database_connection_{id(self)}", default=None
+        )
+        # Текущая единица работы (см. transaction())
+        self._transaction: ContextVar[Optional[Transaction]] = ContextVar(
+            f"database_transaction_{id(self)}", default=None
+        )
+        # Read-through кэш имен; add_user обновляет его при каждой записи
+        self.identity_cache = IdentityCache(self.profile.identity_cache_size, self.profile.identity_cache_ttl_s)
+        # user_id -> username, последний записанный в users. Заполняется в init();
+        # по нему add_user пропускает запись, если ничего не изменилось.
+        self._known_users: Dict[int, str] = {}
+        # Все пары из pair_streaks; по нему проверка существования пары не идет в БД
+        self.known_pairs = PairSet()
+        # Обновления кэшей, ждущие COMMIT писателя вне transaction() (см. _after_commit)
+        self._pending_after_commit: List[Any] = []
+
+    async def _apply_pragmas(self, conn: aiosqlite.Connection, readonly: bool):
+        profile = self.profile
+        await conn.execute(f"PRAGMA busy_timeout = {int(profile.busy_timeout_ms)}")
+        await conn.execute(f"PRAGMA cache_size = -{int(profile.cache_size_kib)}")
+        await conn.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)}")
+        if readonly:
+            await conn.execute("PRAGMA query_only = ON")
+        else:
+            async with conn.execute(f"PRAGMA journal_mode = {profile.journal_mode}") as cursor:
+                mode = (await cursor.fetchone())[0]
+            if mode.lower() != profile.journal_mode.lower():
+                self.logger.warning(f"DB: Requested journal_mode={profile.journal_mode}, SQLite kept {mode}.")
+            await conn.execute(f"PRAGMA synchronous = {profile.synchronous}")
+
+    async def _open_writer(self):
+        # BEGIN IMMEDIATE: при нескольких процессах транзакция сразу берет блокировку записи
+        # (и ждет busy_timeout), а не падает с SQLITE_BUSY при переходе от чтения к записи
+        self._writer = await aiosqlite.connect(self.db_name, isolation_level="IMMEDIATE")
+        await self._apply_pragmas(self._writer, readonly=False)
+
+    async def _open_readers(self):
+        # Файл БД уже создан писателем, поэтому читатели открываются в режиме mode=ro
+        uri = Path(self.db_name).resolve().as_uri() + "?mode=ro"
+        self._read_pool = asyncio.Queue()
+        for _ in range(self.profile.read_pool_size):
+            conn = await aiosqlite.connect(uri, uri=True)
+            await self._apply_pragmas(conn, readonly=True)
+            self._readers.append(conn)
+            self._read_pool.put_nowait(conn)
+        self.logger.info(f"DB: Opened writer + {self.profile.read_pool_size} read-only connections for {self.db_name} ({self.profile}).")
+
+    async def acquire(self, readonly: bool = False) -> aiosqlite.Connection:
+        """Берет соединение: read-only из пула или единственное соединение писателя.
+        Ожидает, если все читатели заняты или писатель используется другой задачей."""
+        if readonly:
+            if self._read_pool is None:
+                raise RuntimeError("Database.init() must be called before using the database")
+            return await self._read_pool.get()
+        if self._writer is None:
+            raise RuntimeError("Database.init() must be called before using the database")
+        await self._write_lock.acquire()
+        return self._writer
+
+    async def release(self, db: aiosqlite.Connection):
+        """Возвращает соединение. Незавершенная транзакция откатывается."""
+        try:
+            if db.in_transaction:
+                await db.rollback()
+        finally:
+            if db is self._writer:
+                # Не дошедшие до _commit изменения откатаны - их обновления кэшей тоже
+                self._pending_after_commit.clear()
+                self._write_lock.release()
+            elif self._read_pool is not None:
+                self._read_pool.put_nowait(db)
+
+    @asynccontextmanager
+    async def _connection(self, readonly: bool) -> AsyncIterator[aiosqlite.Connection]:
+        bound = self._bound_connection.get()
+        tx = self._current_transaction()
+        if tx is not None and bound is not self._writer and (tx.connection is not None or not readonly):
+            # Первая запись в transaction() берет писателя до конца транзакции;
+            # после нее и чтения идут через него (видны собственные изменения)
+            if tx.connection is None:
+                tx.connection = await self.acquire(readonly=False)
+            token = self._bound_connection.set(tx.connection)
+            try:
+                yield tx.connection
+            except BaseException:
+                tx.rollback_only = True
+                raise
+            finally:
+                self._bound_connection.reset(token)
+            return
+        # Чтение внутри любого уже захваченного соединения идет через него же
+        # (видны собственные незакоммиченные изменения), запись - только через писателя.
+        if bound is not None and (readonly or bound is self._writer):
+            try:
+                yield bound
+            except BaseException:
+                if tx is not None:
+                    tx.rollback_only = True
+                raise
+            return
+        db = await self.acquire(readonly)
+        token = self._bound_connection.set(db)
+        try:
+            yield db
+        except BaseException:
+            if tx is not None:
+                tx.rollback_only = True
+            raise
+        finally:
+            self._bound_connection.reset(token)
+            await self.release(db)
+
+    def reader(self):
+        """Контекстный менеджер для чтения (read-only соединение из пула)."""
+        return self._connection(readonly=True)
+
+    def writer(self):
+        """Контекстный менеджер для изменений (единственное соединение писателя)."""
+        return self._connection(readonly=False)
+
+    def _current_transaction(self) -> Optional[Transaction]:
+        """Открытая transaction() текущей задачи."""
+        tx = self._transaction.get()
+        if tx is None or tx.finished or tx.owner is not asyncio.current_task():
+            return None
+        return tx
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        """Единица работы для одного апдейта: `async with db.transaction() as tx: ...`.
+        Методы Database внутри блока пишут через одно соединение писателя, их собственные
+        коммиты откладываются до выхода из блока. Если блок или любой вызванный в нем метод
+        упал (даже поймав ошибку), все изменения откатываются. Вложенный transaction()
+        присоединяется к внешнему."""
+        current = self._current_transaction()
+        if current is not None:
+            yield current
+            return
+        tx = Transaction()
+        token = self._transaction.set(tx)
+        try:
+            yield tx
+            if tx.rollback_only:
+                raise TransactionAborted("an operation inside the transaction failed")
+            if tx.connection is not None:
+                await tx.connection.commit()
+        finally:
+            tx.finished = True
+            self._transaction.reset(token)
+            if tx.connection is not None:
+                await self.release(tx.connection)
+        for callback in tx._after_commit:
+            callback()
+
+    async def _commit(self, db: aiosqlite.Connection):
+        """COMMIT, если метод вызван вне transaction(); внутри него коммитит сам transaction()."""
+        if self._current_transaction() is None:
+            await db.commit()
+            callbacks, self._pending_after_commit = self._pending_after_commit, []
+            for callback in callbacks:
+                callback()
+
+    def _after_commit(self, callback):
+        """Выполняет callback после COMMIT: внутри transaction() - после ее COMMIT,
+        внутри writer() - после _commit этого метода, иначе сразу."""
+        tx = self._current_transaction()
+        if tx is not None:
+            tx.after_commit(callback)
+        elif self._bound_connection.get() is self._writer:
+            self._pending_after_commit.append(callback)
+        else:
+            callback()
+
+    async def close(self):
+        """Закрывает все соединения (вызывается при остановке бота)."""
+        connections = self._readers + ([self._writer] if self._writer else [])
+        self._readers, self._writer, self._read_pool = [], None, None
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                self.logger.error(f"DB: Error closing connection: {e}", exc_info=True)
+        self.logger.info("DB: Connections closed.")
 
     async def init(self):
         """Инициализация базы данных"""
-        async with aiosqlite.connect(self.db_name) as db:
+        if self._writer is None:
+            await self._open_writer()
+        async with self.writer() as db:
             # Проверяем и добавляем столбец balance в таблицу users, если его нет
             async with db.execute("PRAGMA table_info(users)") as cursor:
                 columns = [row[1] for row in await cursor.fetchall()]
-            if 'balance' not in columns:
+            if columns and 'balance' not in columns: # На новой БД таблицы users еще нет
                 await db.execute("ALTER TABLE users ADD COLUMN balance INTEGER DEFAULT 0")
                 self.logger.info("DB: Added 'balance' column to 'users' table.")
             
@@ -42,16 +554,18 @@ class Database:
                     FOREIGN KEY (partner_id) REFERENCES users(user_id)
                 )
             """)
+            # Стрик пары хранится одной строкой с ключом (min(user), max(user))
             await db.execute("""
-                CREATE TABLE IF NOT EXISTS streak_pairs (
-                    user_id INTEGER,
-                    partner_id INTEGER,
+                CREATE TABLE IF NOT EXISTS pair_streaks (
+                    user_lo INTEGER NOT NULL,
+                    user_hi INTEGER NOT NULL,
                     last_streak_date DATE,
                     streak_count INTEGER DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user_id, partner_id),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (partner_id) REFERENCES users(user_id)
+                    PRIMARY KEY (user_lo, user_hi),
+                    CHECK (user_lo < user_hi),
+                    FOREIGN KEY (user_lo) REFERENCES users(user_id),
+                    FOREIGN KEY (user_hi) REFERENCES users(user_id)
                 )
             """)
             await db.execute("""
@@ -75,23 +589,190 @@ class Database:
                     FOREIGN KEY (marked_partner_id) REFERENCES users(user_id)
                 )
             """)
-            # Новая таблица для заморозок
+            # Заморозки, тоже одна строка на пару
             await db.execute("""
-                CREATE TABLE IF NOT EXISTS streak_freezes (
-                    user_id INTEGER NOT NULL,
-                    partner_id INTEGER NOT NULL,
+                CREATE TABLE IF NOT EXISTS pair_freezes (
+                    user_lo INTEGER NOT NULL,
+                    user_hi INTEGER NOT NULL,
                     freeze_end_date DATE NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user_id, partner_id),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (partner_id) REFERENCES users(user_id)
+                    PRIMARY KEY (user_lo, user_hi),
+                    CHECK (user_lo < user_hi),
+                    FOREIGN KEY (user_lo) REFERENCES users(user_id),
+                    FOREIGN KEY (user_hi) REFERENCES users(user_id)
+                )
+            """)
+            await self._migrate_to_canonical_pairs(db)
+            # Журнал всех изменений баланса
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS balance_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    amount INTEGER NOT NULL,
+                    balance_after INTEGER NOT NULL,
+                    reason TEXT NOT NULL,
+                    partner_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS db_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
                 )
             """)
+            await self._migrate_dates_to_days(db)
+            # Сводка активности: одна строка на пару, чат и день с битовой маской «кто писал»
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS pair_daily_activity (
+                    user_lo INTEGER NOT NULL,
+                    user_hi INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    day INTEGER NOT NULL,
+                    spoke_mask INTEGER NOT NULL DEFAULT 0, -- 1: писал user_lo, 2: писал user_hi
+                    PRIMARY KEY (user_lo, user_hi, chat_id, day)
+                ) WITHOUT ROWID
+            """)
+            # Пары, которым за день уже отправлено уведомление о стрике (для теплого перезапуска)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS daily_notifications (
+                    day INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    user_lo INTEGER NOT NULL,
+                    user_hi INTEGER NOT NULL,
+                    PRIMARY KEY (day, chat_id, user_lo, user_hi)
+                ) WITHOUT ROWID
+            """)
+            # Кто писал в чате за день, в том числе пока без пары (для восстановления состояния чата)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS daily_active_users (
+                    day INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    PRIMARY KEY (day, chat_id, user_id)
+                ) WITHOUT ROWID
+            """)
+            if await self._get_meta(db, "activity_rollup") is None:
+                cursor = await db.execute(_ROLLUP_MESSAGES_TEMPLATE.format(condition="1"))
+                await self._set_meta(db, "activity_rollup", "1")
+                self.logger.info(f"DB: Backfilled pair_daily_activity from messages ({cursor.rowcount} rows).")
+            await self._ensure_indexes(db)
             await db.commit()
-            self.logger.info("База данных инициализирована/проверена (с users.balance и streak_freezes).")
+            self.logger.info("База данных инициализирована/проверена (с users.balance и pair_streaks/pair_freezes).")
+            plan_problems = await self.check_query_plans()
+            if plan_problems:
+                self.logger.error(f"DB: Hot queries are not using their indexes: {plan_problems}")
+            async with db.execute("SELECT user_id, username FROM users") as cursor:
+                self._known_users = {user_id: username for user_id, username in await cursor.fetchall()}
+            self.logger.info(f"DB: Loaded {len(self._known_users)} known users.")
+            known_pairs = PairSet()
+            async with db.execute("SELECT user_lo, user_hi FROM pair_streaks ORDER BY user_lo, user_hi") as cursor:
+                async for user_lo, user_hi in cursor:
+                    known_pairs.append_sorted(user_lo, user_hi)
+            self.known_pairs = known_pairs
+            self.logger.info(f"DB: Loaded {len(known_pairs)} known pairs ({known_pairs.nbytes() // 1024} KiB).")
+        if self._read_pool is None:
+            await self._open_readers()
+
+    async def _get_meta(self, db: Any, key: str) -> Optional[str]:
+        async with db.execute("SELECT value FROM db_meta WHERE key = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+    async def _set_meta(self, db: Any, key: str, value: Any):
+        await db.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    async def _migrate_to_canonical_pairs(self, db: Any):
+        """Переносит streak_pairs/streak_freezes из старой схемы (две строки на пару:
+        (A,B) и (B,A)) в pair_streaks/pair_freezes и заменяет старые таблицы
+        одноименными представлениями, чтобы существующие чтения продолжали работать."""
+        async with db.execute("SELECT name, type FROM sqlite_master WHERE name IN ('streak_pairs', 'streak_freezes')") as cursor:
+            legacy = {name for name, obj_type in await cursor.fetchall() if obj_type == 'table'}
+
+        if 'streak_pairs' in legacy:
+            # Если две половины пары разошлись, берем более свежую (NULL-даты идут последними)
+            await db.execute("""
+                INSERT OR IGNORE INTO pair_streaks (user_lo, user_hi, last_streak_date, streak_count, created_at)
+                SELECT MIN(user_id, partner_id), MAX(user_id, partner_id), last_streak_date, streak_count, created_at
+                FROM streak_pairs
+                WHERE user_id <> partner_id
+                ORDER BY last_streak_date DESC, streak_count DESC
+            """)
+            await db.execute("DROP TABLE streak_pairs")
+            self.logger.info("DB: Migrated streak_pairs to canonical pair_streaks (one row per pair).")
+        if 'streak_freezes' in legacy:
+            await db.execute("""
+                INSERT OR IGNORE INTO pair_freezes (user_lo, user_hi, freeze_end_date, created_at)
+                SELECT MIN(user_id, partner_id), MAX(user_id, partner_id), freeze_end_date, created_at
+                FROM streak_freezes
+                WHERE user_id <> partner_id
+                ORDER BY freeze_end_date DESC
+            """)
+            await db.execute("DROP TABLE streak_freezes")
+            self.logger.info("DB: Migrated streak_freezes to canonical pair_freezes (one row per pair).")
+
+        # Представления совместимости: обе «направленные» строки, как в старой схеме
+        await db.execute("""
+            CREATE VIEW IF NOT EXISTS streak_pairs AS
+                SELECT user_lo AS user_id, user_hi AS partner_id, last_streak_date, streak_count, created_at FROM pair_streaks
+                UNION ALL
+                SELECT user_hi AS user_id, user_lo AS partner_id, last_streak_date, streak_count, created_at FROM pair_streaks
+        """)
+        await db.execute("""
+            CREATE VIEW IF NOT EXISTS streak_freezes AS
+                SELECT user_lo AS user_id, user_hi AS partner_id, freeze_end_date, created_at FROM pair_freezes
+                UNION ALL
+                SELECT user_hi AS user_id, user_lo AS partner_id, freeze_end_date, created_at FROM pair_freezes
+        """)
+
+    async def _migrate_dates_to_days(self, db: Any):
+        """Переводит даты из ISO-строк ('YYYY-MM-DD') в номера дней (см. date_to_day)."""
+        if await self._get_meta(db, "date_encoding") == "epoch_day":
+            return
+        for table, column in DAY_COLUMNS:
+            # julianday('1970-01-01') = 2440587.5
+            cursor = await db.execute(f"""
+                UPDATE {table} SET {column} = CAST(julianday({column}) - 2440587.5 AS INTEGER)
+                WHERE typeof({column}) = 'text' AND julianday({column}) IS NOT NULL
+            """)
+            if cursor.rowcount:
+                self.logger.info(f"DB: Converted {cursor.rowcount} {table}.{column} values to epoch days.")
+        await self._set_meta(db, "date_encoding", "epoch_day")
+
+    async def _ensure_indexes(self, db: Any):
+        """Создает индексы из INDEXES и удаляет устаревшие, если версия набора изменилась."""
+        stored_version = await self._get_meta(db, "index_set_version")
+        if stored_version == str(INDEX_SET_VERSION):
+            return
+        async with db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'") as cursor:
+            existing = {row[0] for row in await cursor.fetchall()}
+        for name in existing - INDEXES.keys():
+            await db.execute(f"DROP INDEX IF EXISTS {name}")
+            self.logger.info(f"DB: Dropped obsolete index {name}.")
+        for name, ddl in INDEXES.items():
+            await db.execute(ddl)
+        await self._set_meta(db, "index_set_version", INDEX_SET_VERSION)
+        self.logger.info(f"DB: Index set upgraded from version {stored_version} to {INDEX_SET_VERSION}.")
+
+    async def check_query_plans(self) -> Dict[str, str]:
+        """Прогоняет EXPLAIN QUERY PLAN для HOT_QUERY_PLANS.
+        Возвращает {имя_запроса: план} для запросов, которые не используют ожидаемый индекс."""
+        problems: Dict[str, str] = {}
+        async with self.reader() as db:
+            for name, (sql, params, expected_index) in HOT_QUERY_PLANS.items():
+                async with db.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                    plan = " | ".join(row[3] for row in await cursor.fetchall())
+                if expected_index not in plan:
+                    problems[name] = plan
+        return problems
 
     async def add_user(self, user_id: int, username: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        if self._known_users.get(user_id) == username:
+            if not self.profile.verify_known_users or await self._stored_username(user_id) == username:
+                self.identity_cache.put(user_id, username)
+                return
+        async with self.writer() as db:
             # Сначала пытаемся вставить нового пользователя, игнорируя, если он уже существует
             await db.execute(
                 "INSERT OR IGNORE INTO users (user_id, username, balance) VALUES (?, ?, 0)",
@@ -108,22 +789,42 @@ class Database:
                         (username, user_id)
                     )
                     self.logger.info(f"DB: Updated username for user {user_id} to {username}.")
-            await db.commit()
-            # self.logger.info(f"DB: User {username} ({user_id}) ensured in DB.")
+            await self._commit(db)
+        self._after_commit(lambda: self._remember_user(user_id, username))
+
+    async def _stored_username(self, user_id: int) -> Optional[str]:
+        async with self.reader() as db:
+            async with db.execute("SELECT username FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                result = await cursor.fetchone()
+        return result[0] if result else None
+
+    def _remember_user(self, user_id: int, username: str):
+        self._known_users[user_id] = username
+        self.identity_cache.put(user_id, username)
 
     async def get_user_id_by_username(self, username: str) -> Optional[int]:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT user_id FROM users WHERE username = ?", (username,)) as cursor:
+        cached = self.identity_cache.get_user_id(username)
+        if cached is not None:
+            return cached
+        async with self.reader() as db:
+            async with db.execute("SELECT user_id, username FROM users WHERE username = ? COLLATE NOCASE", (username,)) as cursor:
                 result = await cursor.fetchone()
-                return result[0] if result else None
+        if not result:
+            return None
+        self.identity_cache.put(result[0], result[1])
+        return result[0]
 
     async def get_username_by_id(self, user_id: int) -> Optional[str]:
+        cached = self.identity_cache.get_username(user_id)
+        if cached is not None:
+            return cached
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self.reader() as db:
                 async with db.execute("SELECT username FROM users WHERE user_id = ?", (user_id,)) as cursor:
                     result = await cursor.fetchone()
                     if result:
                         # self.logger.info(f"DB: Username for {user_id} is {result[0]}")
+                        self.identity_cache.put(user_id, result[0])
                         return result[0]
                     else:
                         self.logger.warning(f"DB: Username for {user_id} not found")
@@ -133,33 +834,49 @@ class Database:
             return None
 
     async def add_streak_request(self, from_user_id: int, to_user_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.writer() as db:
             await db.execute("INSERT OR REPLACE INTO streak_requests (from_user_id, to_user_id) VALUES (?, ?)", (from_user_id, to_user_id))
-            await db.commit()
+            await self._commit(db)
 
     async def get_streak_request(self, from_user_id: int, to_user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.reader() as db:
             async with db.execute("SELECT 1 FROM streak_requests WHERE from_user_id = ? AND to_user_id = ?", (from_user_id, to_user_id)) as cursor:
                 return bool(await cursor.fetchone())
 
     async def remove_streak_request(self, from_user_id: int, to_user_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.writer() as db:
             await db.execute("DELETE FROM streak_requests WHERE from_user_id = ? AND to_user_id = ?", (from_user_id, to_user_id))
-            await db.commit()
+            await self._commit(db)
 
-    async def add_streak_pair(self, user_id: int, partner_id: int):
+    async def _ensure_pairs(self, db: Any, keys: Iterable[Tuple[int, int]]) -> int:
+        """Создает отсутствующие пары (ключи pair_key) одним executemany.
+        Известные по known_pairs пары не стоят ни одного запроса. Не коммитит."""
+        missing = self.known_pairs.missing(set(keys))
+        if not missing:
+            return 0
+        await db.executemany(
+            "INSERT OR IGNORE INTO pair_streaks (user_lo, user_hi, streak_count, last_streak_date) VALUES (?, ?, 0, NULL)",
+            missing
+        )
+        self._after_commit(lambda: self.known_pairs.update(missing))
+        return len(missing)
+
+    async def add_streak_pairs(self, pairs: Iterable[Tuple[int, int]]) -> int:
+        """Пакетное создание пар стриков. Возвращает число пар, которых не было в known_pairs."""
+        keys = [pair_key(a, b) for a, b in pairs]
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                async with db.execute("SELECT 1 FROM streak_pairs WHERE (user_id = ? AND partner_id = ?) OR (user_id = ? AND partner_id = ?)", (user_id, partner_id, partner_id, user_id)) as cursor:
-                    if await cursor.fetchone():
-                        self.logger.info(f"DB: Streak pair {user_id}-{partner_id} already exists.")
-                        return
-                await db.execute("INSERT INTO streak_pairs (user_id, partner_id, streak_count, last_streak_date) VALUES (?, ?, 0, NULL)", (user_id, partner_id))
-                await db.execute("INSERT INTO streak_pairs (user_id, partner_id, streak_count, last_streak_date) VALUES (?, ?, 0, NULL)", (partner_id, user_id))
-                await db.commit()
-                self.logger.info(f"DB: Created new streak pair {user_id}-{partner_id}")
+            async with self.writer() as db:
+                created = await self._ensure_pairs(db, keys)
+                if created:
+                    await self._commit(db)
+                    self.logger.info(f"DB: Created {created} new streak pairs.")
+                return created
         except Exception as e:
-            self.logger.error(f"DB: Error in add_streak_pair for {user_id}-{partner_id}: {e}", exc_info=True)
+            self.logger.error(f"DB: Error in add_streak_pairs for {len(keys)} pairs: {e}", exc_info=True)
+            return 0
+
+    async def add_streak_pair(self, user_id: int, partner_id: int):
+        await self.add_streak_pairs([(user_id, partner_id)])
 
     async def _update_streak_state(self, db: Any, user_id1: int, user_id2: int, interaction_date: date) -> bool:
         """
@@ -167,7 +884,7 @@ class Database:
         Возвращает True, если стрик был изменен (увеличен, сброшен), иначе False.
         """
         try:
-            async with db.execute("SELECT last_streak_date, streak_count FROM streak_pairs WHERE user_id = ? AND partner_id = ?", (user_id1, user_id2)) as cursor_streak:
+            async with db.execute("SELECT last_streak_date, streak_count FROM pair_streaks WHERE user_lo = ? AND user_hi = ?", pair_key(user_id1, user_id2)) as cursor_streak:
                 streak_info = await cursor_streak.fetchone()
             
             if not streak_info:
@@ -176,92 +893,136 @@ class Database:
                 # Не будем создавать пару здесь, чтобы не маскировать проблему.
                 return False
 
-            last_streak_dt_str, current_streak = streak_info
+            last_streak_day, current_streak = streak_info
             current_streak = current_streak or 0
-            last_streak_dt = datetime.strptime(last_streak_dt_str, '%Y-%m-%d').date() if last_streak_dt_str else None
+            interaction_day = date_to_day(interaction_date)
 
-            if last_streak_dt == interaction_date:
+            if last_streak_day == interaction_day:
                 self.logger.info(f"DB: _update_streak_state - Interaction for {user_id1}-{user_id2} on {interaction_date} already processed. Streak: {current_streak}")
                 return False # Уже обработано для этой даты
 
             new_streak = current_streak
-            updated_streak_date = last_streak_dt # По умолчанию не меняем, если не выполняются условия ниже
+            updated_streak_day = last_streak_day # По умолчанию не меняем, если не выполняются условия ниже
 
-            if not last_streak_dt: # Первый стрик
+            if last_streak_day is None: # Первый стрик
                 new_streak = 1
-                updated_streak_date = interaction_date
+                updated_streak_day = interaction_day
                 self.logger.info(f"DB: _update_streak_state - Starting new streak for {user_id1}-{user_id2} to 1 on {interaction_date}")
-            elif (interaction_date - last_streak_dt).days == 1: # Продолжение
+            elif interaction_day - last_streak_day == 1: # Продолжение
                 new_streak = current_streak + 1
-                updated_streak_date = interaction_date
+                updated_streak_day = interaction_day
                 self.logger.info(f"DB: _update_streak_state - Continuing streak for {user_id1}-{user_id2} to {new_streak} on {interaction_date}")
-            elif (interaction_date - last_streak_dt).days > 1: # Пропуск, сброс
+            elif interaction_day - last_streak_day > 1: # Пропуск, сброс
                 new_streak = 1
-                updated_streak_date = interaction_date
+                updated_streak_day = interaction_day
                 self.logger.info(f"DB: _update_streak_state - Streak reset for {user_id1}-{user_id2}. New streak: 1 on {interaction_date}")
-            elif interaction_date < last_streak_dt: # Сообщение из прошлого, не должно влиять на будущий стрик
-                self.logger.info(f"DB: _update_streak_state - Interaction date {interaction_date} is older than last_streak_dt {last_streak_dt} for {user_id1}-{user_id2}. No update.")
+            elif interaction_day < last_streak_day: # Сообщение из прошлого, не должно влиять на будущий стрик
+                self.logger.info(f"DB: _update_streak_state - Interaction date {interaction_date} is older than last streak day {last_streak_day} for {user_id1}-{user_id2}. No update.")
                 return False # Не обновляем, если дата взаимодействия раньше последней даты стрика
-            else: # Это случай interaction_date == last_streak_dt, уже покрыт выше.
+            else: # Это случай interaction_day == last_streak_day, уже покрыт выше.
                   # Или какая-то другая непредвиденная логика дат. Оставляем без изменений.
-                self.logger.warning(f"DB: _update_streak_state - Unhandled date condition for {user_id1}-{user_id2}. Interaction: {interaction_date}, Last: {last_streak_dt}. No update.")
+                self.logger.warning(f"DB: _update_streak_state - Unhandled date condition for {user_id1}-{user_id2}. Interaction: {interaction_date}, Last day: {last_streak_day}. No update.")
                 return False
 
-            if new_streak != current_streak or updated_streak_date != last_streak_dt:
-                iso_date = updated_streak_date.isoformat() if updated_streak_date else None
-                await db.execute("UPDATE streak_pairs SET last_streak_date = ?, streak_count = ? WHERE user_id = ? AND partner_id = ?", (iso_date, new_streak, user_id1, user_id2))
-                await db.execute("UPDATE streak_pairs SET last_streak_date = ?, streak_count = ? WHERE user_id = ? AND partner_id = ?", (iso_date, new_streak, user_id2, user_id1))
-                self.logger.info(f"DB: _update_streak_state - Updated streak_pairs for {user_id1}-{user_id2} to count {new_streak}, date {iso_date}")
+            if new_streak != current_streak or updated_streak_day != last_streak_day:
+                await db.execute("UPDATE pair_streaks SET last_streak_date = ?, streak_count = ? WHERE user_lo = ? AND user_hi = ?", (updated_streak_day, new_streak, *pair_key(user_id1, user_id2)))
+                self.logger.info(f"DB: _update_streak_state - Updated pair_streaks for {user_id1}-{user_id2} to count {new_streak}, date {interaction_date}")
                 return True
             return False
         except Exception as e:
             self.logger.error(f"DB: Error in _update_streak_state for {user_id1}-{user_id2} on {interaction_date}: {e}", exc_info=True)
             return False
 
-    async def mark_message(self, user_id: int, partner_id: int, chat_date: date, chat_id_context: int):
-        """Отметка сообщения и обновление стрика, если выполнены условия."""
-        try:
-            async with aiosqlite.connect(self.db_name) as db:
-                await db.execute(
-                    "INSERT OR IGNORE INTO messages (user_id, partner_id, chat_date, chat_id_context) VALUES (?, ?, ?, ?)",
-                    (user_id, partner_id, chat_date, chat_id_context)
-                )
-                self.logger.info(f"DB: mark_message - Recorded message from {user_id} to {partner_id} on {chat_date} in chat {chat_id_context}")
+    async def _apply_mark(self, db: Any, user_id: int, partner_id: int, chat_date: date, chat_id_context: int) -> bool:
+        """Записывает сообщение user_id -> partner_id и, если есть ответное, обновляет стрик.
+        Не коммитит. Возвращает True, если стрик изменился."""
+        chat_day = date_to_day(chat_date)
+        await db.execute(
+            "INSERT OR IGNORE INTO messages (user_id, partner_id, chat_date, chat_id_context) VALUES (?, ?, ?, ?)",
+            (user_id, partner_id, chat_day, chat_id_context)
+        )
+        self.logger.info(f"DB: mark_message - Recorded message from {user_id} to {partner_id} on {chat_date} in chat {chat_id_context}")
 
-                async with db.execute("""
-                    SELECT 1 FROM messages 
-                    WHERE user_id = ? AND partner_id = ? AND chat_date = ? AND chat_id_context = ?
-                """, (partner_id, user_id, chat_date, chat_id_context)) as cursor_partner_message:
-                    partner_also_messaged_today_in_this_chat = await cursor_partner_message.fetchone()
-
-                if partner_also_messaged_today_in_this_chat:
-                    self.logger.info(f"DB: mark_message - Confirmed two-way interaction for {user_id}-{partner_id} on {chat_date} in chat {chat_id_context}. Attempting to update streak state.")
-                    await self._update_streak_state(db, user_id, partner_id, chat_date) # Используем новый внутренний метод
-                else:
-                    self.logger.info(f"DB: mark_message - One-way interaction for {user_id} towards {partner_id} on {chat_date} in chat {chat_id_context}. No streak update yet.")
-                await db.commit()
+        # Та же отметка в сводке; RETURNING сразу показывает, писал ли и партнер
+        async with db.execute("""
+            INSERT INTO pair_daily_activity (user_lo, user_hi, chat_id, day, spoke_mask) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_lo, user_hi, chat_id, day) DO UPDATE SET spoke_mask = spoke_mask | excluded.spoke_mask
+            RETURNING spoke_mask
+        """, (*pair_key(user_id, partner_id), chat_id_context, chat_day, 1 if user_id < partner_id else 2)) as cursor_activity:
+            spoke_mask = (await cursor_activity.fetchone())[0]
+
+        if spoke_mask == 3: # Партнер тоже писал сегодня в этом чате
+            self.logger.info(f"DB: mark_message - Confirmed two-way interaction for {user_id}-{partner_id} on {chat_date} in chat {chat_id_context}. Attempting to update streak state.")
+            return await self._update_streak_state(db, user_id, partner_id, chat_date) # Используем новый внутренний метод
+        self.logger.info(f"DB: mark_message - One-way interaction for {user_id} towards {partner_id} on {chat_date} in chat {chat_id_context}. No streak update yet.")
+        return False
+
+    async def mark_message(self, user_id: int, partner_id: int, chat_date: date, chat_id_context: int) -> bool:
+        """Отметка сообщения и обновление стрика, если выполнены условия.
+        Возвращает True, если стрик изменился. Сообщения групп сюда не идут: все пары
+        сообщения пишет record_pair_interactions одним COMMIT транзакции апдейта."""
+        try:
+            async with self.writer() as db:
+                changed = await self._apply_mark(db, user_id, partner_id, chat_date, chat_id_context)
+                await self._commit(db)
+                return changed
         except Exception as e:
             self.logger.error(f"DB: Error in mark_message for {user_id}-{partner_id} on {chat_date} in {chat_id_context}: {e}", exc_info=True)
+            return False
+
+    async def record_pair_interactions(self, user_id: int, partner_ids: Iterable[int], chat_date: date, chat_id_context: int) -> Dict[int, Tuple[int, int]]:
+        """Подтверждает общение user_id с каждым из partner_ids в чате за день одной транзакцией:
+        создает недостающие пары одним пакетом, записывает оба направления и обновляет стрики.
+        Возвращает {partner_id: (стрик до, стрик после)}; пустой словарь при ошибке."""
+        partner_ids = list(partner_ids)
+        results: Dict[int, Tuple[int, int]] = {}
+        try:
+            async with self.writer() as db:
+                await self._ensure_pairs(db, (pair_key(user_id, partner_id) for partner_id in partner_ids))
+                for partner_id in partner_ids:
+                    key = pair_key(user_id, partner_id)
+                    async with db.execute("SELECT streak_count FROM pair_streaks WHERE user_lo = ? AND user_hi = ?", key) as cursor:
+                        row = await cursor.fetchone()
+                    if row is None:
+                        # known_pairs разошелся с БД (например, пару удалили вручную) - создаем ее здесь
+                        self.logger.warning(f"DB: record_pair_interactions - Pair {key} is in known_pairs but not in pair_streaks, recreating.")
+                        await db.execute(
+                            "INSERT OR IGNORE INTO pair_streaks (user_lo, user_hi, streak_count, last_streak_date) VALUES (?, ?, 0, NULL)", key
+                        )
+                    streak_before = (row[0] or 0) if row else 0
+                    changed = await self._apply_mark(db, user_id, partner_id, chat_date, chat_id_context)
+                    changed = await self._apply_mark(db, partner_id, user_id, chat_date, chat_id_context) or changed
+                    streak_after = streak_before
+                    if changed:
+                        async with db.execute("SELECT streak_count FROM pair_streaks WHERE user_lo = ? AND user_hi = ?", key) as cursor:
+                            streak_after = (await cursor.fetchone())[0] or 0
+                    results[partner_id] = (streak_before, streak_after)
+                await self._commit(db)
+                return results
+        except Exception as e:
+            self.logger.error(f"DB: Error in record_pair_interactions for {user_id} with {len(partner_ids)} partners on {chat_date} in {chat_id_context}: {e}", exc_info=True)
+            return {}
 
     async def mark_webapp_interaction(self, user_id: int, partner_id: int, mark_date: date) -> Tuple[str, bool]:
         status_message = "Произошла ошибка при обработке вашего запроса."
         streak_updated_flag = False
+        mark_day = date_to_day(mark_date)
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self.writer() as db:
                 # Проверяем, не подтвержден ли уже стрик за эту дату
-                async with db.execute("SELECT last_streak_date FROM streak_pairs WHERE user_id = ? AND partner_id = ?", (user_id, partner_id)) as csp:
+                async with db.execute("SELECT last_streak_date FROM pair_streaks WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id)) as csp:
                     sp_info = await csp.fetchone()
-                if sp_info and sp_info[0] and datetime.strptime(sp_info[0], '%Y-%m-%d').date() == mark_date:
+                if sp_info and sp_info[0] == mark_day:
                     status_message = "Общение за сегодня уже подтверждено и стрик обновлен ранее."
                     self.logger.info(f"DB: mark_webapp_interaction - Streak for {user_id}-{partner_id} on {mark_date} already confirmed in streak_pairs.")
                     return status_message, False
 
                 # Добавляем отметку текущего пользователя
-                await db.execute("INSERT OR IGNORE INTO webapp_daily_marks (marker_id, marked_partner_id, mark_date) VALUES (?, ?, ?)", (user_id, partner_id, mark_date))
+                await db.execute("INSERT OR IGNORE INTO webapp_daily_marks (marker_id, marked_partner_id, mark_date) VALUES (?, ?, ?)", (user_id, partner_id, mark_day))
                 self.logger.info(f"DB: mark_webapp_interaction - User {user_id} marked interaction with {partner_id} for {mark_date}.")
 
                 # Проверяем, есть ли ответная отметка от партнера
-                async with db.execute("SELECT 1 FROM webapp_daily_marks WHERE marker_id = ? AND marked_partner_id = ? AND mark_date = ?", (partner_id, user_id, mark_date)) as cursor_partner_mark:
+                async with db.execute("SELECT 1 FROM webapp_daily_marks WHERE marker_id = ? AND marked_partner_id = ? AND mark_date = ?", (partner_id, user_id, mark_day)) as cursor_partner_mark:
                     partner_also_marked = await cursor_partner_mark.fetchone()
 
                 if partner_also_marked:
@@ -272,40 +1033,36 @@ class Database:
                         streak_updated_flag = True
                         # Удаляем обработанные отметки
                         await db.execute("DELETE FROM webapp_daily_marks WHERE mark_date = ? AND ((marker_id = ? AND marked_partner_id = ?) OR (marker_id = ? AND marked_partner_id = ?))", 
-                                         (mark_date, user_id, partner_id, partner_id, user_id))
+                                         (mark_day, user_id, partner_id, partner_id, user_id))
                         self.logger.info(f"DB: mark_webapp_interaction - Processed and deleted webapp_daily_marks for {user_id}-{partner_id} on {mark_date}.")
                     else:
                         # _update_streak_state вернул False, значит стрик уже был обновлен за эту дату или не изменился
                         status_message = "Общение за сегодня уже было учтено ранее."
                         # Можно также удалить отметки, если они все еще там, чтобы не висели
                         await db.execute("DELETE FROM webapp_daily_marks WHERE mark_date = ? AND ((marker_id = ? AND marked_partner_id = ?) OR (marker_id = ? AND marked_partner_id = ?))", 
-                                         (mark_date, user_id, partner_id, partner_id, user_id))
+                                         (mark_day, user_id, partner_id, partner_id, user_id))
                         self.logger.info(f"DB: mark_webapp_interaction - _update_streak_state returned False for {user_id}-{partner_id} on {mark_date}. Marks cleaned up.")
                 else:
                     status_message = "Ваша отметка сохранена. Ожидаем подтверждения от партнера."
                 
-                await db.commit()
+                await self._commit(db)
             return status_message, streak_updated_flag
         except Exception as e:
             self.logger.error(f"DB: Error in mark_webapp_interaction for {user_id}-{partner_id} on {mark_date}: {e}", exc_info=True)
-            # В случае ошибки пытаемся откатить транзакцию, если соединение еще живо
-            if db.is_connected(): 
-                await db.rollback()
+            # Незавершенную транзакцию откатывает release() при возврате соединения в пул
             return "Произошла ошибка при сохранении вашей отметки. Попробуйте позже.", False
 
     async def check_both_marked(self, user_id: int, partner_id: int, chat_date: date, chat_id_context: int) -> bool:
         """Проверка, отметились ли оба пользователя сообщениями в указанный день В УКАЗАННОМ ЧАТЕ."""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                # Проверяем сообщение от user_id к partner_id
-                async with db.execute("SELECT 1 FROM messages WHERE user_id = ? AND partner_id = ? AND chat_date = ? AND chat_id_context = ?", (user_id, partner_id, chat_date, chat_id_context)) as c1:
-                    msg1_exists = await c1.fetchone()
-                # Проверяем сообщение от partner_id к user_id
-                async with db.execute("SELECT 1 FROM messages WHERE user_id = ? AND partner_id = ? AND chat_date = ? AND chat_id_context = ?", (partner_id, user_id, chat_date, chat_id_context)) as c2:
-                    msg2_exists = await c2.fetchone()
-                
-                both_marked = bool(msg1_exists and msg2_exists)
-                self.logger.info(f"DB: check_both_marked for {user_id}-{partner_id} on {chat_date} in chat {chat_id_context}: {both_marked} (msg1: {bool(msg1_exists)}, msg2: {bool(msg2_exists)})")
+            async with self.reader() as db:
+                async with db.execute(
+                    "SELECT spoke_mask FROM pair_daily_activity WHERE user_lo = ? AND user_hi = ? AND chat_id = ? AND day = ?",
+                    (*pair_key(user_id, partner_id), chat_id_context, date_to_day(chat_date))
+                ) as cursor:
+                    result = await cursor.fetchone()
+                both_marked = bool(result and result[0] == 3)
+                self.logger.info(f"DB: check_both_marked for {user_id}-{partner_id} on {chat_date} in chat {chat_id_context}: {both_marked} (mask: {result[0] if result else 0})")
                 return both_marked
         except Exception as e:
             self.logger.error(f"DB: Error in check_both_marked for {user_id}-{partner_id}, date {chat_date}, chat {chat_id_context}: {e}", exc_info=True)
@@ -313,8 +1070,8 @@ class Database:
 
     async def get_streak_count(self, user_id: int, partner_id: int) -> int:
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                async with db.execute("SELECT streak_count FROM streak_pairs WHERE user_id = ? AND partner_id = ?", (user_id, partner_id)) as cursor:
+            async with self.reader() as db:
+                async with db.execute("SELECT streak_count FROM pair_streaks WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id)) as cursor:
                     result = await cursor.fetchone()
                     return result[0] if result else 0
         except Exception as e:
@@ -325,137 +1082,152 @@ class Database:
         """Получение списка стриков пользователя.
         Возвращает список кортежей (partner_id, partner_username, streak_count, freeze_end_date_iso_or_none).
         Если current_chat_id это ID группы, то фильтрует стрики по активности в этой группе.
+        Партнеры, имена, активные заморозки и групповой фильтр считаются одним запросом.
         """
-        streaks_to_show: List[Tuple[int, str, int, Optional[str]]] = []
         try:
-            today = datetime.now(timezone.utc).date() # Нужна текущая дата для get_active_freeze
-            async with aiosqlite.connect(self.db_name) as db:
-                # 1. Получаем все глобальные стрики пользователя
-                async with db.execute("""
-                    SELECT u.user_id, u.username, sp.streak_count
-                    FROM streak_pairs sp
-                    JOIN users u ON u.user_id = sp.partner_id
-                    WHERE sp.user_id = ? AND sp.streak_count > 0 
-                    ORDER BY sp.streak_count DESC
-                """, (current_user_id,)) as cursor:
-                    all_global_streaks_raw = await cursor.fetchall()
-                
-                all_global_streaks: List[Tuple[int, str, int, Optional[str]]] = []
-                for pid, puname, scount in all_global_streaks_raw:
-                    freeze_end_date = await self.get_active_freeze(current_user_id, pid, today)
-                    all_global_streaks.append((pid, puname, scount, freeze_end_date.isoformat() if freeze_end_date else None))
+            today = date_to_day(datetime.now(timezone.utc).date()) # Нужна текущая дата для фильтра активных заморозок
+            # Если current_chat_id == current_user_id, это сигнал, что запрос из ЛС/webapp (показываем все)
+            # Иначе, это ID группы, и мы должны фильтровать по сообщениям в этой группе.
+            is_group_context = current_chat_id != current_user_id
+            if is_group_context:
+                sql = USER_STREAKS_IN_CHAT_SQL
+                params: Tuple[Any, ...] = (current_user_id, current_user_id, today, current_chat_id)
+            else:
+                sql = USER_STREAKS_SQL
+                params = (current_user_id, current_user_id, today)
+            async with self.reader() as db:
+                async with db.execute(sql, params) as cursor:
+                    streaks_to_show: List[Tuple[int, str, int, Optional[str]]] = [
+                        (pid, puname, scount, day_to_date(freeze_day).isoformat() if freeze_day is not None else None)
+                        for pid, puname, scount, freeze_day in await cursor.fetchall()
+                    ]
 
-                self.logger.info(f"DB: get_user_streaks - Found {len(all_global_streaks)} global streaks (with freeze info) for user {current_user_id}.")
-
-                # 2. Фильтруем в зависимости от типа чата
-                # Если current_chat_id == current_user_id, это сигнал, что запрос из ЛС/webapp (показываем все)
-                # Иначе, это ID группы, и мы должны фильтровать.
-                is_group_context = current_chat_id != current_user_id 
-
-                if not is_group_context:
-                    self.logger.info(f"DB: get_user_streaks - Private context (chat_id={current_chat_id}), showing all global streaks.")
-                    streaks_to_show = all_global_streaks
-                else:
-                    self.logger.info(f"DB: get_user_streaks - Group context (chat_id={current_chat_id}), filtering streaks.")
-                    for partner_id, partner_username, streak_count, freeze_date_iso in all_global_streaks:
-                        # Проверяем, было ли взаимодействие current_user_id с partner_id в current_chat_id
-                        async with db.execute("""
-                            SELECT 1 FROM messages 
-                            WHERE chat_id_context = ? AND 
-                                  ((user_id = ? AND partner_id = ?) OR (user_id = ? AND partner_id = ?))
-                            LIMIT 1
-                        """, (current_chat_id, current_user_id, partner_id, partner_id, current_user_id)) as msg_cursor:
-                            interaction_in_this_chat = await msg_cursor.fetchone()
-                        
-                        if interaction_in_this_chat:
-                            self.logger.info(f"DB: get_user_streaks - Streak with {partner_username} ({partner_id}) IS relevant to group {current_chat_id}.")
-                            streaks_to_show.append((partner_id, partner_username, streak_count, freeze_date_iso))
-                        else:
-                            self.logger.info(f"DB: get_user_streaks - Streak with {partner_username} ({partner_id}) NOT relevant to group {current_chat_id} (no messages).")
-            
-            self.logger.info(f"DB: get_user_streaks for user {current_user_id} in chat {current_chat_id} returning: {streaks_to_show}")
+            self.logger.info(f"DB: get_user_streaks for user {current_user_id} in chat {current_chat_id} (group filter: {is_group_context}) returning: {streaks_to_show}")
             return streaks_to_show
         except Exception as e:
             self.logger.error(f"DB: Error in get_user_streaks for user {current_user_id}, chat {current_chat_id}: {e}", exc_info=True)
             return []
 
     async def get_last_chat_date(self, user_id: int, partner_id: int) -> Optional[date]:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT last_streak_date FROM streak_pairs WHERE user_id = ? AND partner_id = ?", (user_id, partner_id)) as cursor:
+        async with self.reader() as db:
+            async with db.execute("SELECT last_streak_date FROM pair_streaks WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id)) as cursor:
                 result = await cursor.fetchone()
-                return datetime.strptime(result[0], '%Y-%m-%d').date() if result and result[0] else None
+                return day_to_date(result[0]) if result and result[0] is not None else None
 
     async def reset_streak(self, user_id: int, partner_id: int) -> bool:
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                async with db.execute("SELECT streak_count FROM streak_pairs WHERE user_id = ? AND partner_id = ?", (user_id, partner_id)) as cursor:
-                    if not await cursor.fetchone(): return False # Нет такого стрика
-                
-                await db.execute("UPDATE streak_pairs SET streak_count = 0, last_streak_date = NULL WHERE (user_id = ? AND partner_id = ?) OR (user_id = ? AND partner_id = ?)", (user_id, partner_id, partner_id, user_id))
+            async with self.writer() as db:
+                cursor = await db.execute("UPDATE pair_streaks SET streak_count = 0, last_streak_date = NULL WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id))
+                if cursor.rowcount == 0: return False # Нет такого стрика
+
                 # Удаляем сообщения только между этими пользователями, но ВЕЗДЕ, т.к. стрик глобальный.
                 # Если нужно удалять только из контекста чата, логика reset усложнится.
                 await db.execute("DELETE FROM messages WHERE (user_id = ? AND partner_id = ?) OR (user_id = ? AND partner_id = ?)", (user_id, partner_id, partner_id, user_id))
+                await db.execute("DELETE FROM pair_daily_activity WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id))
                 await db.execute("DELETE FROM webapp_daily_marks WHERE ((marker_id = ? AND marked_partner_id = ?) OR (marker_id = ? AND marked_partner_id = ?))", (user_id, partner_id, partner_id, user_id)) # Также чистим webapp_daily_marks
-                await db.commit()
+                # Иначе после перезапуска пара снова считалась бы объявленной сегодня
+                await db.execute("DELETE FROM daily_notifications WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id))
+                await self._commit(db)
                 self.logger.info(f"DB: Streak reset for {user_id}-{partner_id}, including webapp marks.")
                 return True
         except Exception as e:
             self.logger.error(f"DB: Error in reset_streak for {user_id}-{partner_id}: {e}", exc_info=True)
             return False 
 
-    async def reset_inactive_streaks(self, current_date: date):
+    async def reset_inactive_streaks(self, current_date: date) -> int:
         """
         Сбрасывает streak_count на 0 для пар, где последнее взаимодействие
         было не вчера и не сегодня (т.е. пропущено более одного дня),
-        ЕСЛИ СТРИК НЕ ЗАМОРОЖЕН.
+        ЕСЛИ СТРИК НЕ ЗАМОРОЖЕН. Истекшие заморозки не мешают сбросу
+        (их удаляет sweep_expired_freezes). Все делается set-based запросами в одной транзакции.
+        Возвращает количество сброшенных пар.
         """
+        today = date_to_day(current_date)
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                # Выбираем user_id, partner_id, last_streak_date, streak_count
-                async with db.execute("SELECT user_id, partner_id, last_streak_date, streak_count FROM streak_pairs WHERE streak_count > 0") as cursor:
-                    active_streaks = await cursor.fetchall()
-                
-                count_reset = 0
-                for user_id, partner_id, last_streak_dt_str, streak_count in active_streaks:
-                    # Проверяем активную заморозку ПЕРЕД любыми действиями
-                    active_freeze_end_date = await self.get_active_freeze(user_id, partner_id, current_date)
-                    if active_freeze_end_date:
-                        self.logger.info(f"DB: reset_inactive_streaks - Streak for {user_id}-{partner_id} is frozen until {active_freeze_end_date}. Skipping reset.")
-                        continue # Пропускаем сброс, если стрик заморожен
-
-                    if not last_streak_dt_str: # Если даты нет, но стрик > 0 - это аномалия, сбрасываем
-                        self.logger.warning(f"DB: reset_inactive_streaks - Anomaly: streak_count > 0 ({streak_count}) but no last_streak_date for {user_id}-{partner_id}. Resetting.")
-                        await db.execute("UPDATE streak_pairs SET streak_count = 0 WHERE user_id = ? AND partner_id = ?", (user_id, partner_id))
-                        await db.execute("UPDATE streak_pairs SET streak_count = 0 WHERE user_id = ? AND partner_id = ?", (partner_id, user_id))
-                        count_reset += 1
-                        continue
-
-                    last_streak_dt = datetime.strptime(last_streak_dt_str, '%Y-%m-%d').date()
-                    
-                    # Если последнее взаимодействие было не вчера и не сегодня, то стрик сбрасывается
-                    # (current_date - last_streak_dt).days == 1 означает, что последнее общение было вчера - это ОК
-                    # (current_date - last_streak_dt).days == 0 означает, что последнее общение было сегодня - это ОК
-                    if (current_date - last_streak_dt).days > 1:
-                        self.logger.info(f"DB: reset_inactive_streaks - Resetting streak for {user_id}-{partner_id}. Last streak: {last_streak_dt}, Current date: {current_date}, Old count: {streak_count}")
-                        await db.execute("UPDATE streak_pairs SET streak_count = 0 WHERE user_id = ? AND partner_id = ?", (user_id, partner_id))
-                        # Обновляем и симметричную пару
-                        await db.execute("UPDATE streak_pairs SET streak_count = 0 WHERE user_id = ? AND partner_id = ?", (partner_id, user_id))
-                        count_reset += 1
-                
-                if count_reset > 0:
-                    await db.commit()
-                    self.logger.info(f"DB: reset_inactive_streaks - Successfully reset {count_reset} inactive streaks.")
-                else:
-                    self.logger.info(f"DB: reset_inactive_streaks - No streaks to reset.")
+            async with self.writer() as db:
+                # last_streak_date < вчера <=> пропущено более одного дня
+                cursor = await db.execute(RESET_INACTIVE_STREAKS_SQL, (today - 1, today))
+                count_reset = cursor.rowcount
+                # Аномалия: streak_count > 0, но даты нет - тоже сбрасываем
+                cursor = await db.execute("""
+                    UPDATE pair_streaks SET streak_count = 0
+                    WHERE streak_count > 0 AND last_streak_date IS NULL
+                """)
+                if cursor.rowcount:
+                    self.logger.warning(f"DB: reset_inactive_streaks - Reset {cursor.rowcount} anomalous pairs with streak_count > 0 but no last_streak_date.")
+                    count_reset += cursor.rowcount
+                await self._commit(db)
+            self.logger.info(f"DB: reset_inactive_streaks - Reset {count_reset} inactive streaks for {current_date}.")
+            return count_reset
         except Exception as e:
             self.logger.error(f"DB: Error in reset_inactive_streaks for date {current_date}: {e}", exc_info=True) 
+            return 0
+
+    async def compact_messages(self, current_date: date, batch_size: int = 5000) -> int:
+        """Сворачивает сырые строки messages старше message_retention_days в
+        pair_daily_activity и удаляет их. Работает пачками, отпуская писателя
+        между ними, чтобы не задерживать обработку сообщений.
+        Возвращает количество удаленных строк."""
+        cutoff = date_to_day(current_date) - self.profile.message_retention_days
+        rollup_sql = _ROLLUP_MESSAGES_TEMPLATE.format(condition="id IN (SELECT value FROM json_each(?))")
+        removed = 0
+        try:
+            while True:
+                async with self.writer() as db:
+                    async with db.execute("SELECT id FROM messages WHERE chat_date < ? LIMIT ?", (cutoff, batch_size)) as cursor:
+                        ids = [row[0] for row in await cursor.fetchall()]
+                    if not ids:
+                        break
+                    ids_json = json.dumps(ids)
+                    await db.execute(rollup_sql, (ids_json,))
+                    await db.execute("DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))", (ids_json,))
+                    await self._commit(db)
+                removed += len(ids)
+            self.logger.info(f"DB: compact_messages - Compacted {removed} raw messages older than {day_to_date(cutoff)}.")
+        except Exception as e:
+            self.logger.error(f"DB: Error in compact_messages for date {current_date}: {e}", exc_info=True)
+        return removed
+
+    async def fold_daily_activity(self, current_date: date, batch_size: int = 5000) -> int:
+        """Сворачивает дневные строки pair_daily_activity старше message_retention_days
+        в одну строку на (пара, чат) с day = ACTIVITY_FOLDED_DAY: для старых дней
+        нужен только факт общения в чате (фильтр get_user_streaks). Так размер
+        сводки и ее индекса ограничен окном хранения и числом пар. Работает пачками,
+        как compact_messages. Возвращает количество свернутых строк."""
+        cutoff = date_to_day(current_date) - self.profile.message_retention_days
+        folded = 0
+        try:
+            while True:
+                async with self.writer() as db:
+                    async with db.execute(FOLD_ACTIVITY_BATCH_SQL, (cutoff, batch_size)) as cursor:
+                        rows = await cursor.fetchall()
+                    if not rows:
+                        break
+                    masks: Dict[Tuple[int, int, int], int] = {}
+                    for user_lo, user_hi, chat_id, day, spoke_mask in rows:
+                        key = (user_lo, user_hi, chat_id)
+                        masks[key] = masks.get(key, 0) | spoke_mask
+                    await db.executemany("""
+                        INSERT INTO pair_daily_activity (user_lo, user_hi, chat_id, day, spoke_mask) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (user_lo, user_hi, chat_id, day) DO UPDATE SET spoke_mask = spoke_mask | excluded.spoke_mask
+                    """, [(*key, ACTIVITY_FOLDED_DAY, mask) for key, mask in masks.items()])
+                    await db.executemany(
+                        "DELETE FROM pair_daily_activity WHERE user_lo = ? AND user_hi = ? AND chat_id = ? AND day = ?",
+                        [row[:4] for row in rows]
+                    )
+                    await self._commit(db)
+                folded += len(rows)
+            self.logger.info(f"DB: fold_daily_activity - Folded {folded} daily activity rows older than {day_to_date(cutoff)}.")
+        except Exception as e:
+            self.logger.error(f"DB: Error in fold_daily_activity for date {current_date}: {e}", exc_info=True)
+        return folded
 
     # --- Функции для баланса и заморозки стриков ---
 
     async def get_user_balance(self, user_id: int) -> int:
         """Получает текущий баланс пользователя."""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self.reader() as db:
                 async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cursor:
                     result = await cursor.fetchone()
                     return result[0] if result else 0
@@ -463,70 +1235,210 @@ class Database:
             self.logger.error(f"DB: Error getting balance for user {user_id}: {e}", exc_info=True)
             return 0 # Возвращаем 0 в случае ошибки, чтобы не блокировать операции
 
-    async def update_user_balance(self, user_id: int, amount_change: int, allow_negative: bool = False) -> bool:
+    async def _adjust_balance(self, db: Any, user_id: int, amount_change: int, reason: str,
+                              partner_id: Optional[int] = None, allow_negative: bool = False) -> Optional[int]:
+        """Атомарно меняет баланс одним условным UPDATE и пишет запись в balance_ledger.
+        Не коммитит. Возвращает новый баланс или None, если пользователя нет
+        или списание увело бы баланс в минус."""
+        async with db.execute(
+            "UPDATE users SET balance = balance + ? WHERE user_id = ? AND (? OR balance + ? >= 0) RETURNING balance",
+            (amount_change, user_id, allow_negative, amount_change)
+        ) as cursor:
+            result = await cursor.fetchone()
+        if not result:
+            return None
+        await db.execute(
+            "INSERT INTO balance_ledger (user_id, amount, balance_after, reason, partner_id) VALUES (?, ?, ?, ?, ?)",
+            (user_id, amount_change, result[0], reason, partner_id)
+        )
+        return result[0]
+
+    async def update_user_balance(self, user_id: int, amount_change: int, allow_negative: bool = False, reason: str = "manual") -> bool:
         """Обновляет баланс пользователя. amount_change может быть положительным (начисление) или отрицательным (списание)."""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                current_balance = await self.get_user_balance(user_id) # Получаем текущий баланс через существующий метод
-                
-                if not allow_negative and (current_balance + amount_change < 0):
-                    self.logger.warning(f"DB: Failed to update balance for user {user_id}. Change {amount_change} would result in negative balance ({current_balance + amount_change}).")
+            async with self.writer() as db:
+                new_balance = await self._adjust_balance(db, user_id, amount_change, reason, allow_negative=allow_negative)
+                if new_balance is None:
+                    self.logger.warning(f"DB: Failed to update balance for user {user_id} by {amount_change} (unknown user or balance would become negative).")
                     return False
-                
-                await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_change, user_id))
-                await db.commit()
-                self.logger.info(f"DB: Updated balance for user {user_id} by {amount_change}. New balance: {current_balance + amount_change}")
+                await self._commit(db)
+                self.logger.info(f"DB: Updated balance for user {user_id} by {amount_change}. New balance: {new_balance}")
                 return True
         except Exception as e:
             self.logger.error(f"DB: Error updating balance for user {user_id}: {e}", exc_info=True)
             return False
 
+    async def purchase_streak_freeze(self, user_id: int, partner_id: int, days: int, cost: int,
+                                     current_date: date, max_total_days: int = 60) -> FreezePurchase:
+        """Покупка заморозки одной транзакцией: продление текущей заморозки (если есть),
+        проверка лимита, атомарное списание баллов, запись заморозки и строки в balance_ledger.
+        При любой неудаче ничего не меняется, поэтому возврат баллов не нужен."""
+        lo, hi = pair_key(user_id, partner_id)
+        today = date_to_day(current_date)
+        try:
+            async with self.writer() as db:
+                async with db.execute(
+                    "SELECT freeze_end_date FROM pair_freezes WHERE user_lo = ? AND user_hi = ? AND freeze_end_date >= ?",
+                    (lo, hi, today)
+                ) as cursor:
+                    result = await cursor.fetchone()
+                previous_end = result[0] if result else None
+                new_end = (previous_end if previous_end is not None else today) + days
+                previous_end_date = day_to_date(previous_end) if previous_end is not None else None
+
+                if new_end - today > max_total_days:
+                    return FreezePurchase(FREEZE_LIMIT_EXCEEDED, previous_end_date, None, None)
+
+                new_balance = await self._adjust_balance(db, user_id, -cost, "streak_freeze", partner_id=partner_id)
+                if new_balance is None:
+                    async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                        result = await cursor.fetchone()
+                    return FreezePurchase(FREEZE_INSUFFICIENT_BALANCE, previous_end_date, None, result[0] if result else 0)
+
+                await self._ensure_pairs(db, [(lo, hi)])
+                await db.execute("INSERT OR REPLACE INTO pair_freezes (user_lo, user_hi, freeze_end_date) VALUES (?, ?, ?)", (lo, hi, new_end))
+                await self._commit(db)
+            self.logger.info(f"DB: User {user_id} bought a {days}-day freeze for pair {user_id}-{partner_id} until {day_to_date(new_end)} (cost {cost}, balance {new_balance}).")
+            return FreezePurchase(FREEZE_OK, previous_end_date, day_to_date(new_end), new_balance)
+        except Exception as e:
+            self.logger.error(f"DB: Error in purchase_streak_freeze for {user_id}-{partner_id}: {e}", exc_info=True)
+            return FreezePurchase(FREEZE_ERROR, None, None, None)
+
     async def add_streak_freeze(self, user_id: int, partner_id: int, freeze_end_date: date) -> bool:
         """Добавляет или обновляет заморозку стрика для пары."""
         try:
-            iso_freeze_end_date = freeze_end_date.isoformat()
-            async with aiosqlite.connect(self.db_name) as db:
-                # INSERT OR REPLACE, чтобы обновить существующую заморозку, если она есть
-                await db.execute("INSERT OR REPLACE INTO streak_freezes (user_id, partner_id, freeze_end_date) VALUES (?, ?, ?)", 
-                                 (user_id, partner_id, iso_freeze_end_date))
-                # Симметричная запись для партнера, если мы хотим, чтобы заморозка была видна обоим
-                # Это вопрос дизайна: замораживает один, но действует для обоих? Пока да.
-                await db.execute("INSERT OR REPLACE INTO streak_freezes (user_id, partner_id, freeze_end_date) VALUES (?, ?, ?)", 
-                                 (partner_id, user_id, iso_freeze_end_date))
-                await db.commit()
-                self.logger.info(f"DB: Added/Updated streak freeze for pair {user_id}-{partner_id} until {iso_freeze_end_date}.")
+            async with self.writer() as db:
+                # INSERT OR REPLACE, чтобы обновить существующую заморозку, если она есть.
+                # Одна строка на пару, поэтому заморозка действует для обоих.
+                await db.execute("INSERT OR REPLACE INTO pair_freezes (user_lo, user_hi, freeze_end_date) VALUES (?, ?, ?)", 
+                                 (*pair_key(user_id, partner_id), date_to_day(freeze_end_date)))
+                await self._commit(db)
+                self.logger.info(f"DB: Added/Updated streak freeze for pair {user_id}-{partner_id} until {freeze_end_date}.")
                 return True
         except Exception as e:
             self.logger.error(f"DB: Error adding streak freeze for {user_id}-{partner_id}: {e}", exc_info=True)
             return False
 
     async def get_active_freeze(self, user_id: int, partner_id: int, current_date: date) -> Optional[date]:
-        """Проверяет, активна ли заморозка для пары на указанную current_date."""
+        """Проверяет, активна ли заморозка для пары на указанную current_date.
+        Чистое чтение: истекшие записи удаляет sweep_expired_freezes."""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                async with db.execute("SELECT freeze_end_date FROM streak_freezes WHERE user_id = ? AND partner_id = ?", (user_id, partner_id)) as cursor:
+            async with self.reader() as db:
+                async with db.execute(
+                    "SELECT freeze_end_date FROM pair_freezes WHERE user_lo = ? AND user_hi = ? AND freeze_end_date >= ?",
+                    (*pair_key(user_id, partner_id), date_to_day(current_date))
+                ) as cursor:
                     result = await cursor.fetchone()
-                    if result and result[0]:
-                        freeze_end_dt = datetime.strptime(result[0], '%Y-%m-%d').date()
-                        if freeze_end_dt >= current_date:
-                            return freeze_end_dt # Заморозка активна
-                        else:
-                            # Заморозка истекла, можно её удалить для очистки
-                            self.logger.info(f"DB: Stale freeze record found for {user_id}-{partner_id} (ended {freeze_end_dt}). Removing.")
-                            await self.remove_streak_freeze(user_id, partner_id) # Вызовем удаление
-                            return None
-                    return None
+                    return day_to_date(result[0]) if result else None
         except Exception as e:
             self.logger.error(f"DB: Error checking active freeze for {user_id}-{partner_id}: {e}", exc_info=True)
             return None
 
+    async def get_active_freezes(self, pairs: Iterable[Tuple[int, int]], current_date: date) -> Dict[Tuple[int, int], date]:
+        """Пакетный вариант get_active_freeze: активные заморозки для многих пар одним запросом.
+        Возвращает {pair_key: freeze_end_date} только для замороженных пар."""
+        keys = list({pair_key(a, b) for a, b in pairs})
+        if not keys:
+            return {}
+        try:
+            async with self.reader() as db:
+                async with db.execute("""
+                    SELECT f.user_lo, f.user_hi, f.freeze_end_date
+                    FROM json_each(?) AS j
+                    JOIN pair_freezes f
+                        ON f.user_lo = json_extract(j.value, '$[0]') AND f.user_hi = json_extract(j.value, '$[1]')
+                    WHERE f.freeze_end_date >= ?
+                """, (json.dumps(keys), date_to_day(current_date))) as cursor:
+                    return {(lo, hi): day_to_date(end_day) for lo, hi, end_day in await cursor.fetchall()}
+        except Exception as e:
+            self.logger.error(f"DB: Error checking active freezes for {len(keys)} pairs: {e}", exc_info=True)
+            return {}
+
+    async def add_daily_notifications(self, chat_id: int, day: date, pairs: Iterable[Tuple[int, int]]):
+        """Запоминает пары, которым за день отправлено уведомление о стрике."""
+        rows = [(date_to_day(day), chat_id, *pair_key(a, b)) for a, b in pairs]
+        if not rows:
+            return
+        try:
+            async with self.writer() as db:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO daily_notifications (day, chat_id, user_lo, user_hi) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                await self._commit(db)
+        except Exception as e:
+            self.logger.error(f"DB: Error in add_daily_notifications for chat {chat_id}: {e}", exc_info=True)
+
+    async def add_daily_active_user(self, chat_id: int, day: date, user_id: int):
+        """Запоминает, что пользователь писал в чате в этот день (первое сообщение за день)."""
+        try:
+            async with self.writer() as db:
+                await db.execute(
+                    "INSERT OR IGNORE INTO daily_active_users (day, chat_id, user_id) VALUES (?, ?, ?)",
+                    (date_to_day(day), chat_id, user_id)
+                )
+                await self._commit(db)
+        except Exception as e:
+            self.logger.error(f"DB: Error in add_daily_active_user for user {user_id} in chat {chat_id}: {e}", exc_info=True)
+
+    async def prune_daily_state(self, current_date: date) -> int:
+        """Удаляет отметки об уведомлениях и активных пользователях за прошлые дни."""
+        day_value = date_to_day(current_date)
+        try:
+            async with self.writer() as db:
+                cursor = await db.execute("DELETE FROM daily_notifications WHERE day < ?", (day_value,))
+                deleted = cursor.rowcount
+                cursor = await db.execute("DELETE FROM daily_active_users WHERE day < ?", (day_value,))
+                deleted += cursor.rowcount
+                await self._commit(db)
+            return deleted
+        except Exception as e:
+            self.logger.error(f"DB: Error in prune_daily_state for date {current_date}: {e}", exc_info=True)
+            return 0
+
+    async def load_daily_state(self, day: date, chat_id: Optional[int] = None) -> DailySnapshot:
+        """Запросы по индексам: активные пользователи, отметки за день (messages)
+        и отправленные уведомления.
+        С chat_id - только для одного чата."""
+        day_value = date_to_day(day)
+        if chat_id is None:
+            chat_filter, chat_args = "", ()
+            marks_sql, marks_args = DAILY_MARKS_SQL, (day_value,)
+        else:
+            chat_filter, chat_args = " AND chat_id = ?", (chat_id,)
+            marks_sql, marks_args = DAILY_CHAT_MARKS_SQL, (day_value, chat_id)
+        async with self.reader() as db:
+            async with db.execute(
+                f"SELECT chat_id, user_id FROM daily_active_users WHERE day = ?{chat_filter}", (day_value, *chat_args)
+            ) as cursor:
+                active = [tuple(row) for row in await cursor.fetchall()]
+            async with db.execute(marks_sql, marks_args) as cursor:
+                marks = [tuple(row) for row in await cursor.fetchall()]
+            async with db.execute(
+                f"SELECT chat_id, user_lo, user_hi FROM daily_notifications WHERE day = ?{chat_filter}", (day_value, *chat_args)
+            ) as cursor:
+                notified = [tuple(row) for row in await cursor.fetchall()]
+        return DailySnapshot(active, marks, notified)
+
+    async def sweep_expired_freezes(self, current_date: date) -> int:
+        """Удаляет все заморозки, истекшие до current_date, одним DELETE по idx_pair_freezes_end.
+        Вызывается по расписанию (при смене дня). Возвращает количество удаленных строк."""
+        try:
+            async with self.writer() as db:
+                cursor = await db.execute("DELETE FROM pair_freezes WHERE freeze_end_date < ?", (date_to_day(current_date),))
+                await self._commit(db)
+            self.logger.info(f"DB: sweep_expired_freezes - Removed {cursor.rowcount} freezes expired before {current_date}.")
+            return cursor.rowcount
+        except Exception as e:
+            self.logger.error(f"DB: Error in sweep_expired_freezes for date {current_date}: {e}", exc_info=True)
+            return 0
+
     async def remove_streak_freeze(self, user_id: int, partner_id: int):
         """Удаляет запись о заморозке стрика для пары."""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                await db.execute("DELETE FROM streak_freezes WHERE user_id = ? AND partner_id = ?", (user_id, partner_id))
-                await db.execute("DELETE FROM streak_freezes WHERE user_id = ? AND partner_id = ?", (partner_id, user_id)) # Симметрично
-                await db.commit()
+            async with self.writer() as db:
+                await db.execute("DELETE FROM pair_freezes WHERE user_lo = ? AND user_hi = ?", pair_key(user_id, partner_id))
+                await self._commit(db)
                 self.logger.info(f"DB: Removed streak freeze for pair {user_id}-{partner_id}.")
         except Exception as e:
             self.logger.error(f"DB: Error removing streak freeze for {user_id}-{partner_id}: {e}", exc_info=True) 
\ No newline at end of file
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def render_digest(entries: List[str], max_length: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Склеивает уведомления в как можно меньшее число сообщений не длиннее max_length.
+    Разрезает только между уведомлениями (или внутри одного слишком длинного)."""
+    chunks: List[str] = []
+    current = ""
+    for entry in entries:
+        if not entry:
+            continue
+        while len(entry) > max_length:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(entry[:max_length])
+            entry = entry[max_length:]
+        if not entry:
+            continue
+        candidate = f"{current}\n\n{entry}" if current else entry
+        if len(candidate) > max_length:
+            chunks.append(current)
+            candidate = entry
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class StreakNotifier:
+    """Копит уведомления о стриках по чатам и через debounce_s после первого
+    отправляет их одним сообщением-дайджестом (разбитым только по лимиту Telegram),
+    чтобы всплеск подтвержденных пар стоил одного вызова API, а не десятков."""
+
+    def __init__(self, send: Callable[[int, str], Awaitable[Any]], debounce_s: float = 3.0,
+                 max_length: int = TELEGRAM_MESSAGE_LIMIT):
+        self._send = send
+        self.debounce_s = debounce_s
+        self.max_length = max_length
+        self._pending: Dict[int, List[str]] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+
+    def add(self, chat_id: int, text: str):
+        """Ставит уведомление в очередь чата; первое уведомление запускает таймер."""
+        self._pending.setdefault(chat_id, []).append(text)
+        if chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.debounce_s)
+        self._timers.pop(chat_id, None)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id: int):
+        entries = self._pending.pop(chat_id, None)
+        if not entries:
+            return
+        for text in render_digest(entries, self.max_length):
+            try:
+                await self._send(chat_id, text)
+            except Exception as e:
+                logger.error(f"Не удалось отправить дайджест стриков в чат {chat_id}: {e}", exc_info=True)
+        logger.info(f"Дайджест из {len(entries)} уведомлений отправлен в чат {chat_id}.")
+
+    async def close(self):
+        """Отменяет таймеры и сразу отправляет все накопленное (при остановке бота)."""
+        timers = list(self._timers.values())
+        self._timers.clear()
+        for task in timers:
+            task.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLock:
+    """Набор asyncio.Lock по ключу. Блокировка существует, пока ее держат или ждут,
+    поэтому словарь не растет с числом чатов. Ожидающие получают ее в порядке
+    прихода (asyncio.Lock - FIFO)."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+        self.waits = 0  # сколько раз пришлось ждать занятый ключ
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    async def acquire(self, key: Hashable):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+        if lock.locked():
+            self.waits += 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._forget(key)
+            raise
+
+    def release(self, key: Hashable):
+        self._locks[key].release()
+        self._forget(key)
+
+    def _forget(self, key: Hashable):
+        self._users[key] -= 1
+        if self._users[key] == 0:
+            del self._users[key]
+            del self._locks[key]
+
+
+class ChatOrderMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: апдейты одного чата обрабатываются строго
+    по очереди и в порядке поступления, апдейты разных чатов - параллельно.
+
+    Ключ - id чата апдейта, а без чата (inline-запросы и т.п.) - id пользователя,
+    который совпадает с id его личного чата. Апдейты без чата и пользователя
+    не блокируются. Одна и та же пара в разных чатах защищена транзакциями БД
+    (record_pair_interactions пишет пару целиком под блокировкой записи)."""
+
+    def __init__(self):
+        self.locks = KeyedLock()
+        self.processed = 0
+
+    @staticmethod
+    def update_key(data: Dict[str, Any]) -> Optional[int]:
+        # event_chat и event_from_user кладет UserContextMiddleware во всех версиях aiogram 3.x
+        chat = data.get("event_chat")
+        if chat is not None:
+            return chat.id
+        user = data.get("event_from_user")
+        return user.id if user is not None else None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        key = self.update_key(data)
+        if key is None:
+            return await handler(event, data)
+        await self.locks.acquire(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.locks.release(key)
+            self.processed += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"processed": self.processed, "waits": self.locks.waits, "busy_chats": len(self.locks)}
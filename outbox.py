@@ -0,0 +1,295 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods.base import TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше - раньше
+PRIORITY_HIGH = 0    # ответы на команды пользователя
+PRIORITY_NORMAL = 1  # уведомления другим пользователям
+PRIORITY_LOW = 2     # дайджесты стриков
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+@dataclass
+class OutboundJob:
+    method: TelegramMethod
+    chat_id: Optional[Any]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+class HeldMessages:
+    """Сообщения, отложенные OutboundDispatcher.holding() до release() (или отброшенные drop())."""
+
+    def __init__(self, outbox: "OutboundDispatcher"):
+        self._outbox = outbox
+        # Задача, открывшая holding(): дочерние задачи отправляют свои сообщения сразу
+        self.owner = asyncio.current_task()
+        self.finished = False
+        self._jobs: List[Tuple[int, OutboundJob]] = []
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def add(self, priority: int, job: OutboundJob):
+        self._jobs.append((priority, job))
+
+    def release(self):
+        """Ставит отложенные сообщения в очередь в порядке submit()."""
+        jobs, self._jobs = self._jobs, []
+        self.finished = True
+        for priority, job in jobs:
+            self._outbox._enqueue(priority, job)
+
+    def drop(self) -> int:
+        """Отбрасывает отложенные сообщения (их future отменяются). Возвращает их число."""
+        jobs, self._jobs = self._jobs, []
+        self.finished = True
+        for _, job in jobs:
+            job.future.cancel()
+        return len(jobs)
+
+
+class OutboundDispatcher:
+    """Единая очередь исходящих вызовов Telegram API.
+
+    Обработчики кладут сюда готовые методы (`outbox.submit(message.answer("..."))` -
+    без await, message.answer лишь создает SendMessage) и сразу возвращаются.
+    Диспетчер отправляет их по приоритету, соблюдая общий лимит и лимит на чат
+    (в одном чате сообщения уходят по одному и по порядку), а на RetryAfter
+    откладывает чат (или всю очередь) на указанное Telegram время.
+    Внутри `with outbox.holding() as held:` submit() не отправляет, а копит сообщения
+    до held.release() - так ответы обработчика уходят только после COMMIT его транзакции.
+    Работает с любым объектом bot, у которого есть `await bot(method)`."""
+
+    def __init__(self, bot: Any, global_rate: float = 30.0, private_chat_rate: float = 1.0,
+                 group_chat_rate: float = 20 / 60, group_chat_burst: float = 3.0,
+                 max_in_flight: int = 8, max_attempts: int = 5):
+        self.bot = bot
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.group_chat_burst = group_chat_burst
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._seq = itertools.count()
+        # (priority, seq, job) - готовые к отправке
+        self._ready: List[Tuple[int, int, OutboundJob]] = []
+        # (ready_at, priority, seq, job) - ждут токена своего чата или истечения RetryAfter
+        self._deferred: List[Tuple[float, int, int, OutboundJob]] = []
+        # Чаты с сообщением в полете и очередь их следующих сообщений
+        self._busy_chats: Set[Any] = set()
+        self._chat_waiting: Dict[Any, List[Tuple[int, int, OutboundJob]]] = {}
+        self._blocked_until: Dict[Any, float] = {}  # chat_id (None - все чаты) -> monotonic
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._pending = 0
+        self._in_flight: Set[asyncio.Task] = set()
+        self._worker: Optional[asyncio.Task] = None
+        self._held: ContextVar[Optional[HeldMessages]] = ContextVar(f"outbox_held_{id(self)}", default=None)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает диспетчер."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox: остановка с {self._pending} неотправленными сообщениями.")
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    def submit(self, method: TelegramMethod, priority: int = PRIORITY_HIGH, hold: bool = True) -> asyncio.Future:
+        """Ставит вызов в очередь. Возвращает future с результатом (ждать не обязательно).
+        Внутри holding() вызов откладывается до release(); hold=False отправляет сразу
+        (тогда future можно ждать, не дожидаясь конца обработчика)."""
+        future = asyncio.get_running_loop().create_future()
+        job = OutboundJob(method=method, chat_id=getattr(method, "chat_id", None), future=future)
+        held = self._held.get()
+        if hold and held is not None and not held.finished and held.owner is asyncio.current_task():
+            held.add(priority, job)
+        else:
+            self._enqueue(priority, job)
+        return future
+
+    @contextmanager
+    def holding(self) -> Iterator[HeldMessages]:
+        """Копит submit() текущей задачи до held.release(); не выпущенное к выходу из блока отбрасывается."""
+        held = HeldMessages(self)
+        token = self._held.set(held)
+        try:
+            yield held
+        finally:
+            self._held.reset(token)
+            if not held.finished:
+                dropped = held.drop()
+                if dropped:
+                    logger.info(f"Outbox: отброшено {dropped} отложенных сообщений.")
+
+    def _enqueue(self, priority: int, job: OutboundJob):
+        job.enqueued_at = time.monotonic()
+        self._pending += 1
+        self._idle.clear()
+        heapq.heappush(self._ready, (priority, next(self._seq), job))
+        self._wakeup.set()
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self._pending - len(self._in_flight),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_avg_s": self.latency_total / self.sent if self.sent else 0.0,
+            "latency_max_s": self.latency_max,
+        }
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= 4096:
+                self._prune(time.monotonic())
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_chat_rate, 1)
+            else:
+                bucket = TokenBucket(self.group_chat_rate, self.group_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self, now: float):
+        """Забывает полные ведра и истекшие RetryAfter - они ничем не отличаются от новых."""
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._busy_chats and bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+        for chat_id, until in list(self._blocked_until.items()):
+            if until <= now:
+                del self._blocked_until[chat_id]
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                _, priority, seq, job = heapq.heappop(self._deferred)
+                heapq.heappush(self._ready, (priority, seq, job))
+            if not self._ready:
+                timeout = self._deferred[0][0] - now if self._deferred else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Общий лимит или глобальный RetryAfter: ждут все
+            global_wait = max(self._global_bucket.delay(now), self._blocked_until.get(None, 0) - now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            entry = heapq.heappop(self._ready)
+            priority, seq, job = entry
+            chat_id = job.chat_id
+            if chat_id is not None:
+                if chat_id in self._busy_chats:
+                    self._chat_waiting.setdefault(chat_id, []).append(entry)
+                    continue
+                bucket = self._chat_bucket(chat_id)
+                chat_wait = max(bucket.delay(now), self._blocked_until.get(chat_id, 0) - now)
+                if chat_wait > 0:
+                    heapq.heappush(self._deferred, (now + chat_wait, priority, seq, job))
+                    continue
+                bucket.take(now)
+                self._busy_chats.add(chat_id)
+            self._global_bucket.take(now)
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(priority, seq, job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, priority: int, seq: int, job: OutboundJob):
+        retry = False
+        try:
+            job.attempts += 1
+            result = await self.bot(job.method)
+            latency = time.monotonic() - job.enqueued_at
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            if not job.future.done():
+                job.future.set_result(result)
+        except TelegramRetryAfter as e:
+            self.retries += 1
+            self._blocked_until[job.chat_id] = time.monotonic() + e.retry_after
+            logger.warning(f"Outbox: RetryAfter {e.retry_after} с для чата {job.chat_id} (попытка {job.attempts}).")
+            retry = job.attempts < self.max_attempts
+            if not retry:
+                self._fail(job, e)
+        except Exception as e:
+            logger.error(f"Outbox: Ошибка отправки {type(job.method).__name__} в чат {job.chat_id}: {e}")
+            self._fail(job, e)
+        finally:
+            self._slots.release()
+            if retry:
+                heapq.heappush(self._ready, (priority, seq, job))
+            else:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._idle.set()
+            if job.chat_id is not None:
+                self._busy_chats.discard(job.chat_id)
+                waiting = self._chat_waiting.pop(job.chat_id, [])
+                for entry in waiting:
+                    heapq.heappush(self._ready, entry)
+            self._wakeup.set()
+
+    def _fail(self, job: OutboundJob, error: Exception):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+            # Большинство вызывающих не ждут future; ошибка уже в логе,
+            # не даем asyncio ругаться на "exception was never retrieved"
+            job.future.exception()
@@ -0,0 +1,79 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Tuple
+
+
+class PairSet:
+    """Компактное множество пар (user_lo, user_hi) для миллионов записей.
+    Пары хранятся упорядоченными блоками по load..2*load штук; блок - два параллельных
+    отсортированных array('q') (16 байт на пару вместо ~200 у set кортежей).
+    Поиск - бинарный по последним парам блоков, затем внутри блока. Вставка сдвигает
+    только свой блок, а переполненный блок делится пополам, поэтому ни одна операция
+    не перестраивает весь набор и не задерживает event loop на больших объемах."""
+
+    def __init__(self, load: int = 1024):
+        self.load = load
+        self._lo_blocks: List[array] = []
+        self._hi_blocks: List[array] = []
+        self._maxes: List[Tuple[int, int]] = []  # последняя пара каждого блока
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _locate(self, key: Tuple[int, int]) -> Tuple[int, int, bool]:
+        """(номер блока, позиция в блоке, есть ли пара). Номер блока = len(блоков), если пара больше всех."""
+        b = bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            return b, 0, False
+        lo, hi = key
+        lo_block, hi_block = self._lo_blocks[b], self._hi_blocks[b]
+        start = bisect_left(lo_block, lo)
+        end = bisect_right(lo_block, lo, start)
+        i = bisect_left(hi_block, hi, start, end)
+        return b, i, i < end and hi_block[i] == hi
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return self._locate(key)[2]
+
+    def append_sorted(self, lo: int, hi: int):
+        """Быстрая загрузка: пары должны идти строго по возрастанию (ORDER BY user_lo, user_hi)."""
+        if not self._lo_blocks or len(self._lo_blocks[-1]) >= self.load:
+            self._lo_blocks.append(array('q'))
+            self._hi_blocks.append(array('q'))
+            self._maxes.append((lo, hi))
+        self._lo_blocks[-1].append(lo)
+        self._hi_blocks[-1].append(hi)
+        self._maxes[-1] = (lo, hi)
+        self._len += 1
+
+    def add(self, key: Tuple[int, int]):
+        b, i, found = self._locate(key)
+        if found:
+            return
+        if b == len(self._maxes):
+            # Больше всех пар - в конец последнего блока
+            self.append_sorted(*key)
+            return
+        lo_block, hi_block = self._lo_blocks[b], self._hi_blocks[b]
+        lo_block.insert(i, key[0])
+        hi_block.insert(i, key[1])
+        self._len += 1
+        if len(lo_block) > 2 * self.load:
+            half = len(lo_block) // 2
+            self._lo_blocks.insert(b + 1, lo_block[half:])
+            self._hi_blocks.insert(b + 1, hi_block[half:])
+            del lo_block[half:]
+            del hi_block[half:]
+            self._maxes.insert(b, (lo_block[-1], hi_block[-1]))
+
+    def missing(self, keys: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        return [key for key in keys if key not in self]
+
+    def update(self, keys: Iterable[Tuple[int, int]]):
+        for key in keys:
+            self.add(key)
+
+    def nbytes(self) -> int:
+        """Примерный объем памяти (массивы + последние пары блоков)."""
+        return self._len * 2 * array('q').itemsize + len(self._maxes) * 120
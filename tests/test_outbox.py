@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from outbox import OutboundDispatcher, TokenBucket
+
+
+class FakeBot:
+    """Вместо Bot: `await bot(method)` запоминает вызов; failures[текст] - ошибка для этого сообщения."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = []  # (monotonic, chat_id, text)
+        self.in_flight = {}
+        self.max_in_flight_per_chat = 0
+        self.failures = {}
+
+    async def __call__(self, method):
+        chat_id = method.chat_id
+        self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+        self.max_in_flight_per_chat = max(self.max_in_flight_per_chat, self.in_flight[chat_id])
+        try:
+            await asyncio.sleep(self.delay)
+            error = self.failures.pop(method.text, None)
+            if error is not None:
+                raise error
+            self.calls.append((time.monotonic(), chat_id, method.text))
+            return method.text
+        finally:
+            self.in_flight[chat_id] -= 1
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket(rate=2.0, capacity=1)
+    now = bucket.updated
+    assert bucket.delay(now) == 0
+    bucket.take(now)
+    assert abs(bucket.delay(now) - 0.5) < 1e-9
+    assert abs(bucket.delay(now + 0.25) - 0.25) < 1e-9
+    assert bucket.delay(now + 0.5) == 0
+
+
+def test_messages_in_one_chat_keep_order():
+    async def scenario():
+        bot = FakeBot(delay=0.005)
+        outbox = OutboundDispatcher(bot, global_rate=1000, private_chat_rate=1000, group_chat_rate=1000,
+                                    group_chat_burst=1000, max_in_flight=8)
+        outbox.start()
+        futures = [
+            outbox.submit(SendMessage(chat_id=chat_id, text=f"{chat_id}:{n}"))
+            for n in range(10) for chat_id in (-1, -2, 3)
+        ]
+        results = await asyncio.gather(*futures)
+        await outbox.close()
+        return bot, results
+
+    bot, results = asyncio.run(scenario())
+    assert len(results) == 30
+    assert bot.max_in_flight_per_chat == 1
+    for chat_id in (-1, -2, 3):
+        sent = [text for _, chat, text in bot.calls if chat == chat_id]
+        assert sent == [f"{chat_id}:{n}" for n in range(10)]
+
+
+def test_private_chat_rate_limit():
+    async def scenario():
+        bot = FakeBot()
+        outbox = OutboundDispatcher(bot, global_rate=1000, private_chat_rate=20)
+        outbox.start()
+        await asyncio.gather(*(outbox.submit(SendMessage(chat_id=7, text=str(n))) for n in range(4)))
+        await outbox.close()
+        return bot
+
+    bot = asyncio.run(scenario())
+    times = [moment for moment, _, _ in bot.calls]
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    # Одно сообщение в 1/20 с; первое уходит сразу
+    assert all(gap >= 0.045 for gap in gaps), gaps
+
+
+def test_group_chat_burst_then_rate():
+    async def scenario():
+        bot = FakeBot()
+        outbox = OutboundDispatcher(bot, global_rate=1000, group_chat_rate=10, group_chat_burst=3)
+        outbox.start()
+        started = time.monotonic()
+        await asyncio.gather(*(outbox.submit(SendMessage(chat_id=-5, text=str(n))) for n in range(5)))
+        await outbox.close()
+        return bot, started
+
+    bot, started = asyncio.run(scenario())
+    offsets = [moment - started for moment, _, _ in bot.calls]
+    # Три сообщения из запаса сразу, затем по одному в 0.1 с
+    assert offsets[2] < 0.05
+    assert offsets[3] >= 0.09
+    assert offsets[4] >= 0.19
+
+
+def test_retry_after_is_retried_after_the_pause():
+    async def scenario():
+        bot = FakeBot()
+        method = SendMessage(chat_id=-9, text="hello")
+        bot.failures["hello"] = TelegramRetryAfter(method=method, message="Flood control", retry_after=1)
+        outbox = OutboundDispatcher(bot, global_rate=1000, group_chat_rate=1000, group_chat_burst=1000)
+        outbox.start()
+        started = time.monotonic()
+        result = await outbox.submit(method)
+        await outbox.close()
+        return bot, outbox, result, started
+
+    bot, outbox, result, started = asyncio.run(scenario())
+    assert result == "hello"
+    assert outbox.retries == 1
+    assert outbox.metrics()["sent"] == 1
+    assert bot.calls[0][0] - started >= 0.95
+
+
+def test_retry_after_gives_up_after_max_attempts():
+    async def scenario():
+        bot = FakeBot()
+        method = SendMessage(chat_id=-9, text="hello")
+        bot.failures["hello"] = TelegramRetryAfter(method=method, message="Flood control", retry_after=0)
+        outbox = OutboundDispatcher(bot, global_rate=1000, group_chat_rate=1000, group_chat_burst=1000, max_attempts=1)
+        outbox.start()
+        future = outbox.submit(method)
+        await asyncio.gather(future, return_exceptions=True)
+        await outbox.close()
+        return outbox, future
+
+    outbox, future = asyncio.run(scenario())
+    assert isinstance(future.exception(), TelegramRetryAfter)
+    assert outbox.failed == 1
+
+
+def test_holding_sends_only_after_release():
+    async def scenario():
+        bot = FakeBot()
+        outbox = OutboundDispatcher(bot, global_rate=1000, private_chat_rate=1000)
+        outbox.start()
+        with outbox.holding() as held:
+            first = outbox.submit(SendMessage(chat_id=1, text="ok"))
+            immediate = outbox.submit(SendMessage(chat_id=2, text="now"), hold=False)
+            await immediate
+            sent_before_release = [text for _, _, text in bot.calls]
+            held.release()
+        await first
+        await outbox.close()
+        return bot, sent_before_release
+
+    bot, sent_before_release = asyncio.run(scenario())
+    assert sent_before_release == ["now"]
+    assert [text for _, _, text in bot.calls] == ["now", "ok"]
+
+
+def test_holding_drops_unreleased_messages():
+    async def scenario():
+        bot = FakeBot()
+        outbox = OutboundDispatcher(bot, global_rate=1000)
+        outbox.start()
+        with outbox.holding():
+            future = outbox.submit(SendMessage(chat_id=1, text="lost"))
+
+        async def child():
+            return await outbox.submit(SendMessage(chat_id=3, text="child"))
+
+        # Задача, созданная внутри блока, отправляет свои сообщения сразу
+        with outbox.holding():
+            task = asyncio.create_task(child())
+        await task
+        await outbox.close()
+        return bot, outbox, future
+
+    bot, outbox, future = asyncio.run(scenario())
+    assert future.cancelled()
+    assert [text for _, _, text in bot.calls] == ["child"]
+    assert outbox.metrics()["queue_depth"] == 0
@@ -0,0 +1,15 @@
+import asyncio
+
+from database import Database
+
+
+def test_hot_queries_use_their_indexes(tmp_path):
+    async def run():
+        db = Database(str(tmp_path / "plans.db"))
+        await db.init()
+        try:
+            return await db.check_query_plans()
+        finally:
+            await db.close()
+
+    assert asyncio.run(run()) == {}
@@ -0,0 +1,119 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import BoundedRequestHandler
+from workers import RoutingRequestHandler
+
+SECRET = "s3cret"
+PATH = "/telegram/webhook"
+
+# Апдейт в том виде, в котором его присылает Telegram
+RECORDED_UPDATE = {
+    "update_id": 100500,
+    "message": {
+        "message_id": 42,
+        "date": 1760659200,
+        "chat": {"id": -1001234567890, "type": "supergroup", "title": "Streaks"},
+        "from": {"id": 111, "is_bot": False, "first_name": "Alice", "username": "alice"},
+        "text": "привет",
+    },
+}
+
+
+async def post_update(headers):
+    """Поднимает aiohttp-приложение с BoundedRequestHandler и отправляет в него RECORDED_UPDATE."""
+    received = []
+    done = asyncio.Event()
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message):
+        received.append((message.chat.id, message.from_user.username, message.text))
+        done.set()
+
+    bot = Bot("123456:TEST")
+    handler = BoundedRequestHandler(dispatcher=dp, bot=bot, secret_token=SECRET, max_concurrent_updates=2)
+    app = web.Application()
+    handler.register(app, path=PATH)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        response = await client.post(PATH, json=RECORDED_UPDATE, headers=headers)
+        status = response.status
+        if status == 200:
+            await asyncio.wait_for(done.wait(), 5)
+            # Слот освобождается в finally фоновой задачи, после обработчика
+            for _ in range(100):
+                if handler.in_flight == 0:
+                    break
+                await asyncio.sleep(0.01)
+    finally:
+        await client.close()
+        await bot.session.close()
+    return status, received, handler.in_flight
+
+
+def test_update_with_secret_is_processed():
+    status, received, in_flight = asyncio.run(post_update({"X-Telegram-Bot-Api-Secret-Token": SECRET}))
+    assert status == 200
+    assert received == [(-1001234567890, "alice", "привет")]
+    assert in_flight == 0
+
+
+def test_update_without_secret_is_rejected():
+    status, received, in_flight = asyncio.run(post_update({}))
+    assert status == 401
+    assert received == []
+    assert in_flight == 0
+
+
+def test_update_with_wrong_secret_is_rejected():
+    status, received, _ = asyncio.run(post_update({"X-Telegram-Bot-Api-Secret-Token": "wrong"}))
+    assert status == 401
+    assert received == []
+
+
+class RecordingSupervisor:
+    def __init__(self):
+        self.updates = []
+
+    def dispatch(self, update):
+        self.updates.append(update)
+
+
+async def post_to_supervisor(headers):
+    """То же для вебхука супервизора: апдейт должен уйти воркеру через dispatch()."""
+    supervisor = RecordingSupervisor()
+    bot = Bot("123456:TEST")
+    handler = RoutingRequestHandler(supervisor, dispatcher=Dispatcher(), bot=bot, secret_token=SECRET,
+                                    max_concurrent_updates=2)
+    app = web.Application()
+    handler.register(app, path=PATH)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        response = await client.post(PATH, json=RECORDED_UPDATE, headers=headers)
+        for _ in range(100):
+            if handler.in_flight == 0:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await client.close()
+        await bot.session.close()
+    return response.status, supervisor.updates, handler.in_flight
+
+
+def test_supervisor_routes_update_with_secret():
+    status, updates, in_flight = asyncio.run(post_to_supervisor({"X-Telegram-Bot-Api-Secret-Token": SECRET}))
+    assert status == 200
+    assert updates == [RECORDED_UPDATE]
+    assert in_flight == 0
+
+
+def test_supervisor_rejects_update_without_secret():
+    status, updates, _ = asyncio.run(post_to_supervisor({}))
+    assert status == 401
+    assert updates == []
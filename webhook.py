@@ -0,0 +1,44 @@
+import asyncio
+from typing import Any, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука aiogram с ограничением числа одновременно обрабатываемых апдейтов.
+
+    Telegram получает ответ сразу (апдейт обрабатывается в фоне), но новый POST
+    не принимается, пока занято max_concurrent_updates слотов: запрос ждет,
+    и Telegram сам притормаживает доставку вместо того, чтобы мы копили задачи.
+    Заголовок X-Telegram-Bot-Api-Secret-Token проверяется, если задан secret_token.
+    Для локальной проверки достаточно отправить POST с JSON апдейта на путь вебхука."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: Optional[str] = None,
+                 max_concurrent_updates: int = 100, **data: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self.in_flight = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+        self.in_flight += 1
+        try:
+            return await super()._handle_request_background(bot=bot, request=request)
+        except BaseException:
+            # Фоновая задача не создана (например, битый JSON) - слот освобождаем здесь
+            self._release()
+            raise
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        try:
+            await super()._background_feed_update(bot=bot, update=update)
+        finally:
+            self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._slots.release()
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import multiprocessing
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from aiogram import Bot, Dispatcher
+
+from webhook import BoundedRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# Апдейты, у которых есть чат; для групп чат определяет воркер
+_CHAT_UPDATE_KEYS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "my_chat_member", "chat_member", "chat_join_request",
+)
+_GROUP_CHAT_TYPES = ("group", "supergroup")
+
+
+def route_update(update: Dict[str, Any], workers: int) -> int:
+    """Номер воркера для апдейта: группы - chat_id % workers (у каждого воркера свои чаты
+    и свои дневные кеши), личные чаты, колбэки и все остальное - воркер 0."""
+    for key in _CHAT_UPDATE_KEYS:
+        chat = (update.get(key) or {}).get("chat")
+        if chat is not None:
+            if chat.get("type") in _GROUP_CHAT_TYPES:
+                return chat["id"] % workers
+            break
+    return 0
+
+
+class WorkerSupervisor:
+    """Запускает N процессов-воркеров и раздает им апдейты по route_update.
+
+    Каждый воркер - отдельный процесс со своим event loop, Bot, Dispatcher и
+    соединениями с общей БД SQLite (WAL). target(worker_index, worker_count, queue)
+    вызывается в дочернем процессе; апдейты приходят в queue как dict, None - стоп."""
+
+    def __init__(self, target: Callable[[int, int, Any], None], workers: int):
+        self._context = multiprocessing.get_context("spawn")
+        self.target = target
+        self.workers = workers
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.routed = [0] * workers
+        self._monitor: Optional[asyncio.Task] = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=self.target,
+            args=(index, self.workers, self.queues[index]),
+            name=f"streak-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Supervisor: воркер {index} запущен (pid {process.pid}).")
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self._monitor = asyncio.create_task(self._watch())
+
+    async def _watch(self, interval: float = 5.0):
+        """Перезапускает упавших воркеров; очередь сохраняется, апдейты не теряются."""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Supervisor: воркер {index} завершился с кодом {process.exitcode}, перезапуск.")
+                    self._spawn(index)
+
+    def dispatch(self, update: Dict[str, Any]):
+        index = route_update(update, self.workers)
+        self.queues[index].put(update)
+        self.routed[index] += 1
+
+    async def stop(self, timeout: float = 30.0):
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Supervisor: воркер {index} не остановился за {timeout} с, завершаем принудительно.")
+                process.terminate()
+        logger.info(f"Supervisor: остановлен, апдейтов по воркерам: {self.routed}")
+
+    async def poll(self, bot: Bot, allowed_updates: List[str], timeout: int = 30):
+        """Long polling в супервизоре: забирает апдейты и раскладывает по воркерам."""
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"Supervisor: ошибка get_updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.dispatch(update.model_dump(mode="json", by_alias=True, exclude_unset=True))
+                offset = update.update_id + 1
+
+    def webhook_handler(self, dispatcher: Dispatcher, bot: Bot, secret_token: Optional[str] = None,
+                        max_concurrent_updates: int = 100) -> "RoutingRequestHandler":
+        """Обработчик вебхука (см. RoutingRequestHandler); подключается через .register(app, path=...)."""
+        return RoutingRequestHandler(self, dispatcher=dispatcher, bot=bot, secret_token=secret_token,
+                                     max_concurrent_updates=max_concurrent_updates)
+
+
+class RoutingRequestHandler(BoundedRequestHandler):
+    """Вебхук супервизора: секрет и предел одновременных запросов - как в BoundedRequestHandler,
+    но апдейт не обрабатывается здесь, а отдается воркеру. Обработку ограничивает
+    consume_updates каждого воркера тем же числом слотов."""
+
+    def __init__(self, supervisor: WorkerSupervisor, dispatcher: Dispatcher, bot: Bot,
+                 secret_token: Optional[str] = None, max_concurrent_updates: int = 100):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token,
+                         max_concurrent_updates=max_concurrent_updates)
+        self.supervisor = supervisor
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        try:
+            self.supervisor.dispatch(update)
+        finally:
+            self._release()
+
+
+async def consume_updates(queue: Any, handle: Callable[[Dict[str, Any]], Awaitable[Any]], max_concurrent: int = 100):
+    """Цикл воркера: читает апдейты из очереди супервизора и обрабатывает их конкурентно
+    (не больше max_concurrent одновременно). Возвращается после None и завершения обработки."""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_concurrent)
+    tasks: Set[asyncio.Task] = set()
+
+    async def run(update: Dict[str, Any]):
+        try:
+            await handle(update)
+        except Exception as e:
+            logger.error(f"Worker: ошибка обработки апдейта {update.get('update_id')}: {e}", exc_info=True)
+        finally:
+            slots.release()
+
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        await slots.acquire()
+        task = asyncio.create_task(run(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)